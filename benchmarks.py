@@ -0,0 +1,455 @@
+# benchmarks.py
+# Copyright (C) 2012 the Pyramidion authors and contributors
+# <see AUTHORS file>
+#
+# This module is part of Pyramidion and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+
+""" Benchmarks of the CRUD and search hot paths on in-memory SQLite.
+
+Run all benchmarks, or the ones starting with the given prefixes:
+
+    python benchmarks.py [--rows 1000] [--width 10] [forms. search.]
+
+Measure the time and memory taken by imports of JSON-only (ember) and
+HTML (deform views) deployments, each in a new interpreter:
+
+    python benchmarks.py --imports
+
+Save results as a baseline, then compare later runs against it:
+
+    python benchmarks.py --save baseline.json
+    python benchmarks.py --compare baseline.json --threshold 0.2
+
+The exit status is 1 when the throughput of a benchmark drops more
+than ``threshold`` below the baseline. Baselines depend on the machine:
+record them on the machine running the comparison.
+"""
+
+from __future__ import print_function
+
+from collections import OrderedDict
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from pyramid import testing
+from pyramid.request import Request
+from sqlalchemy import (Boolean,
+                        Column,
+                        ForeignKey,
+                        Integer,
+                        Unicode,
+                        create_engine)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import (relationship,
+                            sessionmaker)
+import crudalchemy
+import sqlalchemy
+
+try:
+    from urllib import urlencode
+
+except ImportError:
+    from urllib.parse import urlencode
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """ Register a benchmark: the decorated function takes the
+    Environment and returns the callable to time.
+    """
+
+    def decorator(fn):
+        BENCHMARKS[name] = fn
+        return fn
+
+    return decorator
+
+
+# Types of the generated columns, cycled through.
+COLUMN_TYPES = (lambda: Unicode(64), Integer, Boolean)
+
+
+def make_models(width):
+    """ Return (Base, Category, Item): Item has ``width`` columns
+    col_0... and a many-to-one relationship to Category.
+    """
+    Base = declarative_base(cls=crudalchemy.CRUDBase)
+
+    class Category(Base):
+        __tablename__ = 'categories'
+        id = Column(Integer, primary_key=True)
+        name = Column(Unicode(64), nullable=False)
+
+    attrs = {'__tablename__': 'items',
+             'id': Column(Integer, primary_key=True),
+             'category_id': Column(Integer, ForeignKey('categories.id')),
+             'category': relationship(lambda: Category)}
+    for i in range(width):
+        type_ = COLUMN_TYPES[i % len(COLUMN_TYPES)]
+        attrs['col_{}'.format(i)] = Column(type_(), index=True)
+
+    Item = type('Item', (Base,), attrs)
+    return Base, Category, Item
+
+
+def make_value(rnd, column):
+    if isinstance(column.type, Unicode):
+        return u'value {}'.format(rnd.randint(0, 99))
+
+    if isinstance(column.type, Boolean):
+        return rnd.random() < 0.5
+
+    return rnd.randint(0, 999)
+
+
+class Environment(object):
+    """ Database, adapters and requests shared by benchmarks. """
+
+    def __init__(self, rows, width, seed=0):
+        self.rows = rows
+        self.width = width
+        self.config = testing.setUp()
+        self.engine = create_engine('sqlite://')
+        Base, self.Category, self.Item = make_models(width)
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.fill(seed)
+        self._deform = None
+        self._ember = None
+
+    def fill(self, seed):
+        rnd = random.Random(seed)
+        categories = [self.Category(name=u'category {}'.format(i))
+                      for i in range(20)]
+        self.session.add_all(categories)
+        columns = [column for column in self.Item.__table__.columns
+                   if column.key.startswith('col_')]
+        for i in range(self.rows):
+            values = {column.key: make_value(rnd, column)
+                      for column in columns}
+            self.session.add(self.Item(category=rnd.choice(categories),
+                                       **values))
+
+        self.session.commit()
+
+    @property
+    def deform(self):
+        if self._deform is None:
+            # Imported when used, so that ember benchmarks run without
+            # the deform stack.
+            import deform
+            import deform_bootstrap
+            from pyramidion.views import DeformBase
+            dirs = [os.path.join(os.path.dirname(module.__file__),
+                                 'templates')
+                    for module in (deform_bootstrap, deform)]
+            deform.Form.set_zpt_renderer(dirs)
+            self._deform = DeformBase(self.Item, session=self.session)
+            for action, route_name in self._deform.routes.items():
+                path = '/items/{}'.format(action)
+                if action not in ('new', 'create', 'search'):
+                    path += '/{id}'
+
+                self.config.add_route(route_name, path)
+
+        return self._deform
+
+    @property
+    def ember(self):
+        if self._ember is None:
+            from pyramidion.ember import EmberDataBase
+            self._ember = EmberDataBase(self.Item, session=self.session)
+
+        return self._ember
+
+    def request(self, params=(), matchdict=None):
+        request = Request.blank('/?' + urlencode(list(params)))
+        request.registry = self.config.registry
+        request.matchdict = matchdict or {}
+        # Adapters use it when the session they were built with is None.
+        request.db_session = self.session
+        return request
+
+    def criterion(self, i, comparator='__eq__'):
+        """ Return the do_search kwargs filtering on col_i. """
+        name = 'col_{}'.format(i)
+        column = self.Item.__table__.columns[name]
+        value = make_value(random.Random(i), column)
+        return {'{}_criterion'.format(name): {name: value,
+                                              'comparator': comparator}}
+
+
+def make_form_benchmark(action):
+
+    def bench(env):
+        adapter = env.deform
+        pks = {'id': 1}
+        get_form = getattr(adapter, 'get_{}_form'.format(action))
+        if action == 'create':
+            return lambda: get_form(None, env.request())
+
+        if action == 'edit':
+            return lambda: get_form(None, env.request(), **pks)
+
+        if action == 'search':
+            # Forms are memoized per request.
+            return lambda: get_form(env.request())
+
+        return lambda: get_form(env.request(), **pks)
+
+    return bench
+
+
+for action in ('create', 'edit', 'update', 'delete', 'search'):
+    benchmark('forms.{}'.format(action))(make_form_benchmark(action))
+
+
+def make_search_benchmark(criteria, deep=False):
+
+    def bench(env):
+        adapter = env.deform
+        kwargs = {'limit': 25}
+        for i in range(min(criteria, env.width)):
+            comparator = '__eq__' if i % 3 else '__neq__'
+            kwargs.update(env.criterion(i, comparator))
+
+        if deep:
+            kwargs['start'] = max(env.rows - 50, 0)
+
+        def search():
+            request = env.request()
+            result = adapter.do_search(None, request, **dict(kwargs))
+            return list(result.results)
+
+        def lookups():
+            stats = adapter.statement_cache.stats()
+            return stats['shapes_seen'] + stats['new_shapes']
+
+        # Baked searches look up their statement: fail rather than time
+        # the unbaked path.
+        before = lookups()
+        search()
+        if lookups() == before:
+            raise AssertionError('Search {} did not use a baked '
+                                 'query.'.format(sorted(kwargs)))
+
+        return search
+
+    return bench
+
+
+benchmark('search.criteria_0')(make_search_benchmark(0))
+benchmark('search.criteria_1')(make_search_benchmark(1))
+benchmark('search.criteria_3')(make_search_benchmark(3))
+benchmark('search.criteria_0_deep_offset')(make_search_benchmark(0, True))
+benchmark('search.criteria_3_deep_offset')(make_search_benchmark(3, True))
+
+
+@benchmark('search.result_rows')
+def bench_result_rows(env):
+    from pyramidion.widget import SearchResult
+    adapter = env.deform
+    objs = env.session.query(env.Item).limit(100).all()
+    result = SearchResult(objs, cols=adapter.get_search_columns())
+    return lambda: list(result.rows())
+
+
+@benchmark('search.paginator_pages')
+def bench_paginator_pages(env):
+    from pyramidion.widget import Paginator
+    paginator = Paginator(total=env.rows, start=env.rows // 2, limit=25)
+
+    def pages():
+        return list(paginator.get_pages(-5)) + list(paginator.get_pages(5))
+
+    return pages
+
+
+@benchmark('ember.read')
+def bench_ember_read(env):
+    adapter = env.ember
+    return lambda: adapter.read(None, env.request(matchdict={'id': '1'}))
+
+
+@benchmark('ember.search')
+def bench_ember_search(env):
+    adapter = env.ember
+    query = json.dumps({'limit': 100})
+    return lambda: adapter.search(None, env.request([('query', query)]))
+
+
+def measure(fn, repeat, min_time):
+    """ Return the best time of ``repeat`` runs of ``fn``, in seconds per
+    call: every run calls it as many times as fit in ``min_time``.
+    """
+    number = 1
+    while True:
+        start = time.time()
+        for _ in range(number):
+            fn()
+
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+
+        number *= 10 if elapsed < min_time / 10 else 2
+
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        start = time.time()
+        for _ in range(number):
+            fn()
+
+        best = min(best, (time.time() - start) / number)
+
+    return best
+
+
+def run(names, rows, width, repeat, min_time):
+    env = Environment(rows, width)
+    results = OrderedDict()
+    for name in names:
+        fn = BENCHMARKS[name](env)
+        seconds = measure(fn, repeat, min_time)
+        results[name] = {'seconds': seconds, 'ops': 1.0 / seconds}
+        print('{:<36} {:>12.1f} ops/s'.format(name, 1.0 / seconds))
+
+    return results
+
+
+# Module imported by each deployment.
+IMPORTS = OrderedDict([('imports.json', 'pyramidion.ember'),
+                       ('imports.html', 'pyramidion.views')])
+
+IMPORT_SCRIPT = """
+import json, resource, sys, time
+start = time.time()
+import {}
+seconds = time.time() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == 'darwin':
+    rss //= 1024
+print(json.dumps({{'seconds': seconds,
+                  'rss_kb': rss,
+                  'deform': 'deform' in sys.modules}}))
+"""
+
+
+def run_imports(names, repeat):
+    """ Import modules of IMPORTS ``repeat`` times, in new interpreters:
+    keep the fastest import and the max RSS of its interpreter.
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    results = OrderedDict()
+    for name in names:
+        script = IMPORT_SCRIPT.format(IMPORTS[name])
+        runs = [json.loads(subprocess.check_output([sys.executable,
+                                                    '-c',
+                                                    script],
+                                                   cwd=cwd).decode('utf-8'))
+                for _ in range(repeat)]
+        result = min(runs, key=lambda run: run['seconds'])
+        result['ops'] = 1.0 / result['seconds']
+        results[name] = result
+        print('{:<36} {:>9.1f} ms {:>9} kB RSS{}'.format(
+            name,
+            result['seconds'] * 1000,
+            result['rss_kb'],
+            ' (deform loaded)' if result['deform'] else ''))
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Print results against ``baseline``: return names of benchmarks
+    slower than baseline by more than ``threshold``.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        change = result['ops'] / baseline[name]['ops'] - 1
+        flag = ''
+        if change < -threshold:
+            regressions.append(name)
+            flag = ' REGRESSION'
+
+        print('{:<36} {:>12.1f} ops/s {:>+8.1%}{}'.format(name,
+                                                         result['ops'],
+                                                         change,
+                                                         flag))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('prefixes', nargs='*',
+                        help='run benchmarks starting with these prefixes')
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--width', type=int, default=10,
+                        help='number of generated columns')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--imports', action='store_true',
+                        help='measure imports instead of benchmarks')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum duration of a run, in seconds')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save results as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare results to a baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='maximum throughput drop, e.g. 0.2 for 20%%')
+    args = parser.parse_args(argv)
+
+    names = [name for name in (IMPORTS if args.imports else BENCHMARKS)
+             if not args.prefixes or
+             any(name.startswith(prefix) for prefix in args.prefixes)]
+    params = {'rows': args.rows, 'width': args.width}
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        if baseline['params'] != params:
+            print('Baseline params {} differ from {}.'.format(
+                baseline['params'], params))
+            return 2
+
+    if args.imports:
+        results = run_imports(names, args.repeat)
+
+    else:
+        results = run(names, args.rows, args.width, args.repeat,
+                      args.min_time)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'params': params,
+                       'python': platform.python_version(),
+                       'sqlalchemy': sqlalchemy.__version__,
+                       'results': results},
+                      f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        print()
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print('{} benchmarks regressed more than {:.0%}.'.format(
+                len(regressions), args.threshold))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
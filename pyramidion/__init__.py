@@ -5,9 +5,37 @@
 # This module is part of Pyramidion and is released under
 # the MIT License: http://www.opensource.org/licenses/mit-license.php
 
-from .views import DeformBase
 from .utils import setup_routing
 from .widget import (Paginator,
                      SearchResult)
+import importlib
+import sys
 
 __all__ = ['DeformBase', 'setup_routing']
+
+# Names imported on first access: pyramidion.views loads deform,
+# deformalchemy and colanderalchemy, which JSON-only applications using
+# pyramidion.ember do not need.
+LAZY_NAMES = {'DeformBase': '.views'}
+
+
+def __getattr__(name):
+    try:
+        module = LAZY_NAMES[name]
+
+    except KeyError:
+        raise AttributeError("module {!r} has no attribute {!r}".format(
+            __name__, name))
+
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(LAZY_NAMES))
+
+
+if sys.version_info < (3, 7):
+    # Module __getattr__ (PEP 562) is not supported: import now.
+    from .views import DeformBase
@@ -0,0 +1,147 @@
+# Copyright (C) 2012 the Pyramidion authors and contributors
+# <see AUTHORS file>
+#
+# This module is part of Pyramidion and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+
+""" Query budgets: count the statements a session runs for a request.
+
+A QueryBudget attached to a session counts its statements and the ones
+repeated with different parameters only, the signature of N+1 lazy
+loads. When ``limit`` statements or ``repeat_limit`` repetitions of a
+statement are exceeded it logs a warning or, in 'raise' mode, raises
+QueryBudgetExceeded from the statement exceeding them.
+"""
+
+from collections import Counter
+from sqlalchemy import event
+import logging
+
+__all__ = ['QueryBudget', 'QueryBudgetExceeded', 'attach_budget',
+           'attach_request_budget', 'detach_budget', 'get_budget']
+
+log = logging.getLogger(__file__)
+
+# Key of the budget in Session.info.
+BUDGET_KEY = 'pyramidion_query_budget'
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryBudget(object):
+
+    def __init__(self, limit=None, repeat_limit=None, mode='log', name=None):
+        if mode not in ('log', 'raise'):
+            raise ValueError("mode must be 'log' or 'raise'.")
+
+        self.limit = limit
+        self.repeat_limit = repeat_limit
+        self.mode = mode
+        self.name = name
+        self.count = 0
+        self.statements = Counter()
+
+    def record(self, statement):
+        self.count += 1
+        self.statements[statement] += 1
+        # Report only the statement crossing a limit, not the next ones.
+        if self.limit is not None and self.count == self.limit + 1:
+            self.exceeded('{} exceeded its budget of {} queries.'.format(
+                self.name or 'Request', self.limit))
+
+        repeats = self.statements[statement]
+        if self.repeat_limit is not None and \
+           repeats == self.repeat_limit + 1:
+            self.exceeded('{} ran a statement more than {} times, '
+                          'N+1 queries?\n{}'.format(self.name or 'Request',
+                                                    self.repeat_limit,
+                                                    statement))
+
+    def exceeded(self, msg):
+        if self.mode == 'raise':
+            raise QueryBudgetExceeded(msg)
+
+        log.warning(msg)
+
+    def repeated(self):
+        """ Return [(statement, count), ...] of statements run more than
+        once, most repeated first.
+        """
+        return [(statement, count)
+                for statement, count in self.statements.most_common()
+                if count > 1]
+
+
+def get_budget(session):
+    return session.info.get(BUDGET_KEY)
+
+
+def record_statement(session):
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        budget = session.info.get(BUDGET_KEY)
+        if budget is not None:
+            budget.record(statement)
+
+    return before_cursor_execute
+
+
+def listen_connection(session, transaction, connection):
+    listener = session.info.get('pyramidion_budget_listener')
+    if not event.contains(connection, 'before_cursor_execute', listener):
+        event.listen(connection, 'before_cursor_execute', listener)
+
+
+def attach_budget(session, budget):
+    """ Count the statements run by ``session`` in ``budget``, replacing
+    the budget attached before, if any.
+
+    Statements are counted on the connection the session already uses,
+    if any, and on the ones it begins from now on.
+    """
+    if 'pyramidion_budget_listener' not in session.info:
+        session.info['pyramidion_budget_listener'] = record_statement(session)
+        event.listen(session, 'after_begin', listen_connection)
+        transaction = session.transaction
+        # Connections by bind and by connection, SQLAlchemy has no public
+        # API to list them.
+        connections = getattr(transaction, '_connections', None) or {}
+        for values in list(connections.values()):
+            listen_connection(session, transaction, values[0])
+
+    session.info[BUDGET_KEY] = budget
+    return budget
+
+
+def detach_budget(session, budget=None):
+    """ Stop counting the statements of ``session``, if still in
+    ``budget`` when given.
+    """
+    if budget is None or get_budget(session) is budget:
+        session.info.pop(BUDGET_KEY, None)
+
+
+def attach_request_budget(request, session, limits, default=None,
+                          repeat_limit=None, mode='log'):
+    """ Attach to ``session`` the budget of ``request``, created on the
+    first call with the limit of the matched route in ``limits``, or
+    ``default``. The budget is detached once the request is finished:
+    sessions shared by requests must not count in it afterwards.
+    """
+    budget = getattr(request, BUDGET_KEY, None)
+    if budget is None:
+        route = getattr(request, 'matched_route', None)
+        name = None if route is None else route.name
+        budget = QueryBudget(limits.get(name, default), repeat_limit, mode,
+                             name)
+        setattr(request, BUDGET_KEY, budget)
+
+    if get_budget(session) is not budget:
+        attach_budget(session, budget)
+        request.add_finished_callback(
+            lambda request: detach_budget(session, budget))
+
+    return budget
@@ -0,0 +1,418 @@
+# Copyright (C) 2012 the Pyramidion authors and contributors
+# <see AUTHORS file>
+#
+# This module is part of Pyramidion and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+
+from .utils import hash_payload
+from collections import OrderedDict
+from sqlalchemy import inspect
+import copy
+import logging
+import pickle
+import threading
+import time
+import weakref
+
+try:
+    from sqlalchemy.ext import baked
+
+except ImportError:  # SQLAlchemy < 1.0
+    baked = None
+
+__all__ = ['FormCache',
+           'LRUCache',
+           'ObjectCache',
+           'PopulationCache',
+           'RenderCache',
+           'StatementCache']
+
+log = logging.getLogger(__file__)
+
+
+def clone_form(form):
+    """ Return a clone of ``form`` and its fields, as Field.clone.
+
+    Field.clone creates the clone calling ``form.__class__(form.schema)``
+    which fails for forms whose first argument is the mapped class, as
+    SQLAlchemyForm: the form itself is copied without calling __init__.
+    """
+    cloned = copy.copy(form)
+    cloned.order = next(cloned.counter)
+    cloned.oid = 'deformField%s' % cloned.order
+    cloned._parent = None
+    children = []
+    for field in form.children:
+        child = field.clone()
+        child._parent = weakref.ref(cloned)
+        children.append(child)
+
+    cloned.children = children
+    return cloned
+
+
+def populate_form(field, session, populate=None):
+    """ Populate the widgets of the children of ``field`` calling
+    ``populate(widget, session)``, or the widget ``populate`` method.
+
+    Clones of a cached form share widgets: each field gets a copy of
+    its widget, so values set for a request do not leak to others.
+    """
+    for child in field.children:
+        widget = child.widget
+        if hasattr(widget, 'populate'):
+            widget = copy.copy(widget)
+            child.widget = widget
+            if populate is None:
+                widget.populate(session)
+
+            else:
+                populate(widget, session)
+
+        populate_form(child, session, populate)
+
+
+class FormCache(object):
+    """ Cache of prototype forms keyed by (model, action, style).
+
+    Building a form walks the whole mapper through colanderalchemy:
+    the prototype is built once and every call returns a clone of it.
+    Clones share schema and widgets with the prototype, so callers must
+    only change per-request attributes (e.g. ``action``) and widget
+    values that are the same for every request.
+    """
+
+    def __init__(self):
+        self.forms = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, cls, action, style, factory):
+        key = (cls, action, style)
+        try:
+            form = self.forms[key]
+
+        except KeyError:
+            with self.lock:
+                form = self.forms.get(key)
+                if form is None:
+                    log.debug('Build form %s.', key)
+                    form = self.forms[key] = factory(style)
+                    self.misses += 1
+
+                else:
+                    self.hits += 1
+
+        else:
+            self.hits += 1
+
+        return clone_form(form)
+
+    def clear(self):
+        with self.lock:
+            self.forms.clear()
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.forms)}
+
+
+class LRUCache(object):
+    """ Thread safe mapping bounded to ``maxsize`` entries.
+
+    Least recently used entries are evicted first; when ``ttl`` is given
+    entries older than ``ttl`` seconds are treated as missing.
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, value = self.data.pop(key)
+
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= time.time():
+                self.misses += 1
+                return default
+
+            # Re-insert to mark the entry as the most recently used.
+            self.data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.time() + ttl
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (expires, value)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def keys(self):
+        with self.lock:
+            return list(self.data)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.data)}
+
+
+class PopulationCache(object):
+    """ Cache of the values loaded by SQLAlchemy widgets ``populate``.
+
+    Entries are keyed by the widget target class and label/value/order_by
+    columns, so forms of different models sharing a lookup table share
+    the same entry. Widgets using filters are always populated from DB.
+    ``generation`` changes whenever loaded values differ from the ones
+    loaded before for the same entry, or the cache is cleared.
+
+    Entries are not keyed by database: share a cache between the
+    adapters of one database only. Rows written outside the adapters
+    invalidating it are seen after ``ttl`` seconds.
+    """
+
+    def __init__(self, maxsize=128, ttl=60):
+        self.entries = LRUCache(maxsize=maxsize, ttl=ttl)
+        # Hashes of the values last loaded by key, kept after entries
+        # expire or are invalidated to tell whether values changed.
+        self.digests = LRUCache(maxsize=maxsize)
+        self.generation = 0
+
+    def get_target(self, class_):
+        if not isinstance(class_, type):
+            # Dotted name, as accepted by DottedNameResolver.
+            return str(class_).replace(':', '.')
+
+        return '{}.{}'.format(class_.__module__, class_.__name__)
+
+    def get_key(self, widget):
+        return (self.get_target(widget.class_),
+                widget.value,
+                widget.label,
+                widget.order_by)
+
+    def populate(self, widget, session):
+        if not hasattr(widget, 'class_') or getattr(widget, 'filters', None):
+            widget.populate(session)
+            return
+
+        key = self.get_key(widget)
+        values = self.entries.get(key)
+        if values is None:
+            widget.populate(session)
+            self.entries.set(key, widget.values)
+            digest = hash_payload(widget.values)
+            if self.digests.get(key) != digest:
+                self.digests.set(key, digest)
+                self.generation += 1
+
+        else:
+            widget.values = values
+
+    def populate_form(self, field, session):
+        populate_form(field, session, self.populate)
+
+    def invalidate(self, cls):
+        target = self.get_target(cls)
+        for key in self.entries.keys():
+            if key[0] == target:
+                self.entries.delete(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.digests.clear()
+        self.generation += 1
+
+    def stats(self):
+        return self.entries.stats()
+
+
+
+class PlainQuery(object):
+    """ Stand-in of BakedQuery used when baked queries are not available.
+
+    Steps are run, and the SQL compiled, every time it is called.
+    """
+
+    def __init__(self, fn, steps=()):
+        self.steps = [fn] + list(steps)
+
+    def add_criteria(self, fn, *args):
+        self.steps.append(fn)
+        return self
+
+    def with_criteria(self, fn, *args):
+        return PlainQuery(self.steps[0], self.steps[1:] + [fn])
+
+    def __call__(self, session):
+        query = self.steps[0](session)
+        for fn in self.steps[1:]:
+            query = fn(query)
+
+        return query
+
+
+class StatementCache(object):
+    """ Baked queries, whose SQL is compiled once per query shape.
+
+    Callers build queries with bound parameters, passing to ``query``
+    a key describing their shape: ``listener``, if given, is called with
+    (key, seen) on every lookup, seen being True for shapes looked up
+    before. stats() counts lookups of shapes seen and new shapes: they
+    are not bakery hits, the bakery keeps its own cache.
+    """
+
+    def __init__(self, size=200, listener=None):
+        if baked is None:
+            self.bakery = PlainQuery
+
+        else:
+            self.bakery = baked.bakery(size=size)
+
+        self.shapes = LRUCache(maxsize=size)
+        self.listener = listener
+
+    def query(self, key, fn, *args):
+        """ Return a baked query starting from fn(session).
+
+        ``args`` must identify ``fn`` closure, since baked queries are
+        cached by code object: e.g. the mapped class.
+        """
+        seen = self.shapes.get(key) is not None
+        if not seen:
+            self.shapes.set(key, True)
+
+        if self.listener is not None:
+            self.listener(key, seen)
+
+        return self.bakery(fn, *args)
+
+    def get(self, session, cls, ident):
+        """ Return the instance of ``cls`` with PK ``ident`` or None.
+
+        As Query.get, the identity map is looked up before the DB.
+        """
+        bq = self.query(('get', cls), lambda session: session.query(cls), cls)
+        return bq(session).get(ident)
+
+    def stats(self):
+        stats = self.shapes.stats()
+        return {'shapes_seen': stats['hits'],
+                'new_shapes': stats['misses'],
+                'size': stats['size']}
+
+
+class ObjectCache(object):
+    """ Read-through cache of mapped instances keyed by (model, PK).
+
+    Instances are stored pickled, detached from any session, so
+    ``backend`` can be any object with ``get(key, default)``,
+    ``set(key, value, ttl=None)`` and ``delete(key)``, as LRUCache or a
+    shared cache client. Cached instances are merged into the session
+    without loading, unless the session holds the instance already.
+    Entries older than ``ttl`` seconds are reloaded from DB: it bounds
+    staleness when rows change outside the views invalidating them.
+    """
+
+    def __init__(self, backend=None, ttl=30, maxsize=1024):
+        if backend is None:
+            backend = LRUCache(maxsize=maxsize, ttl=ttl)
+
+        self.backend = backend
+        self.ttl = ttl
+
+    def get_key(self, cls, ident):
+        # PKs from matchdict are strings, from JSON bodies are not.
+        return ('{}.{}'.format(cls.__module__, cls.__name__),
+                tuple([str(value) for value in ident]))
+
+    def get(self, session, cls, ident, loader):
+        """ Return the instance of ``cls`` with PK ``ident`` or None.
+
+        On a miss ``loader(session, cls, ident)`` loads the instance.
+        """
+        key = self.get_key(cls, ident)
+        data = self.backend.get(key)
+        if data is None:
+            obj = loader(session, cls, ident)
+            if obj is not None:
+                self.backend.set(key,
+                                 pickle.dumps(obj, pickle.HIGHEST_PROTOCOL),
+                                 self.ttl)
+
+            return obj
+
+        obj = pickle.loads(data)
+        identity = inspect(obj).mapper.identity_key_from_instance(obj)
+        current = session.identity_map.get(identity)
+        if current is not None:
+            return current
+
+        return session.merge(obj, load=False)
+
+    def invalidate(self, cls, ident):
+        self.backend.delete(self.get_key(cls, ident))
+
+
+class RenderCache(object):
+    """ Cache of forms rendered HTML keyed by (model, PK, ...).
+
+    Callers add to the key whatever else ends up in the HTML, e.g.
+    action, template, form action URL and widgets population, and
+    invalidate the entries of an object when it changes. Entries older
+    than ``ttl`` seconds, if given, are rendered again.
+    """
+
+    def __init__(self, maxsize=512, ttl=None):
+        self.entries = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def get_key(self, cls, ident, extra=()):
+        return ('{}.{}'.format(cls.__module__, cls.__name__),
+                tuple([str(value) for value in ident])) + tuple(extra)
+
+    def get(self, cls, ident, extra, render):
+        """ Return the HTML cached for the key, or cache ``render()``. """
+        key = self.get_key(cls, ident, extra)
+        html = self.entries.get(key)
+        if html is None:
+            html = render()
+            self.entries.set(key, html)
+
+        return html
+
+    def invalidate(self, cls, ident):
+        prefix = self.get_key(cls, ident)
+        for key in self.entries.keys():
+            if key[:2] == prefix:
+                self.entries.delete(key)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return self.entries.stats()
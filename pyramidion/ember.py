@@ -1,10 +1,67 @@
+# Copyright (C) 2012 the Pyramidion authors and contributors
+# <see AUTHORS file>
+#
+# This module is part of Pyramidion and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+
+from .budget import attach_request_budget
+from .cache import StatementCache
+from .search import (QuerySpecCompiler,
+                     compute_facets,
+                     get_keyset_keys,
+                     get_projection,
+                     get_search_metadata,
+                     search_with_keyset)
+from .serializer import (Serializer,
+                         StreamingJSON)
+from .timing import (phase,
+                     timed)
+from .utils import (check_not_modified,
+                    get_validators,
+                    hash_payload,
+                    time_steps)
+from pyramid.exceptions import ConfigurationError
+from pyramid.httpexceptions import HTTPNotModified
+from pyramid.interfaces import IRendererFactory
+from sqlalchemy import (and_,
+                        inspect)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import (Session,
+                            configure_mappers)
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import NoResultFound
+import colander
+import crudalchemy
+import json
+import logging
+
+log = logging.getLogger(__file__)
 
 
 class EmberDataBase(crudalchemy.Base):
 
+    # When True search selects only the columns of read_schema, as plain
+    # rows, if read_schema has no relationships.
+    search_projection = False
+    # Renderer of views: set stream_json and a StreamingJSON renderer to
+    # write search results while they are serialized, see stream_search.
+    renderer = 'json'
+    stream_json = False
+    # Rows fetched at a time by streamed searches without limit.
+    stream_chunk_size = 500
+    # Facets and aggregates added to search meta, see DeformBase.
+    search_facets = ()
+    search_aggregates = {}
+    # Query budgets, see DeformBase.
+    query_budgets = {}
+    query_budget = None
+    query_repeat_limit = None
+    query_budget_mode = 'log'
+
     def __init__(self, cls, session=None, db_session_key='db_session',
                  create_schema=None, read_schema=None,
-                 update_schema=None, delete_schema=None):
+                 update_schema=None, delete_schema=None,
+                 statement_cache=None, object_cache=None):
 
         super(EmberDataBase, self).__init__(cls, session,
                                                    create_schema=create_schema,
@@ -16,17 +73,43 @@ class EmberDataBase(crudalchemy.Base):
         self.element = getattr(cls, '__singular__', cls.__name__).lower()
         self.collection = getattr(cls, '__plural__',
                                   self.element + 's').lower()
+        self.serializers = {}
+        self.query_compiler = QuerySpecCompiler(cls)
+        self.statement_cache = statement_cache or StatementCache()
+        # Optional, e.g. ObjectCache(): disabled by default.
+        self.object_cache = object_cache
+
+    def get_session(self, request):
+        session = self.session or getattr(request, self.db_session_key)
+        if self.query_budget is not None or self.query_budgets or \
+           self.query_repeat_limit is not None:
+            attach_request_budget(request,
+                                  session,
+                                  self.query_budgets,
+                                  self.query_budget,
+                                  self.query_repeat_limit,
+                                  self.query_budget_mode)
+
+        return session
 
     def create(self, context, request):
 
+        if self.is_bulk_request(request):
+            return self.create_many(context, request)
+
         response = {}
 
         try:
-            session = self.session or getattr(request, self.db_session_key)
-            params = self.get_create_params(request)
-            obj = super(EmberDataBase, self).create(session, **params)
-            session.flush()
-            response[self.element] = self.create_schema.dictify(obj)
+            session = self.get_session(request)
+            with phase(request, 'validate'):
+                params = self.get_create_params(request)
+
+            with phase(request, 'query'):
+                obj = super(EmberDataBase, self).create(session, **params)
+                session.flush()
+
+            with phase(request, 'dictify'):
+                response[self.element] = self.create_schema.dictify(obj)
 
         except colander.Invalid:
             log.exception('Bad request.')
@@ -46,7 +129,8 @@ class EmberDataBase(crudalchemy.Base):
         else:
             log.debug('Creation succeed.')
             status = 201
-            session.commit()
+            with phase(request, 'commit'):
+                session.commit()
 
         finally:
             request.response.status = status
@@ -55,24 +139,187 @@ class EmberDataBase(crudalchemy.Base):
 
     def get_create_params(self, request):
         params = request.json_body.get(self.element, {})
-        r = self.create_schema.registry
+        return self.filter_params(params, self.create_schema)
+
+    def filter_params(self, params, schema):
+        r = schema.registry
         for key in r.attrs:
             if key in r.excludes or (r.includes and key not in r.includes):
-                params.pop(key)
+                params.pop(key, None)
 
         return params
 
+    def is_bulk_request(self, request):
+        try:
+            return self.collection in request.json_body
+
+        except ValueError:
+            return False
+
+    def create_many(self, context, request):
+
+        # Bulk create, as sent by Ember Data bulk commit:
+        # POST /accounts {"accounts": [{...}, ...]}
+        # Invalid items are reported and skipped, the others are
+        # inserted within a single flush and commit.
+
+        response = {}
+        statuses = []
+
+        try:
+            session = self.get_session(request)
+            items = self.get_many_params(request, self.create_schema)
+            objs = []
+            for params in items:
+                try:
+                    appstruct = self.create_schema.deserialize(params)
+
+                except colander.Invalid as e:
+                    statuses.append({'status': 400, 'errors': e.asdict()})
+                    objs.append(None)
+
+                else:
+                    statuses.append({'status': 201})
+                    objs.append(self.cls(**appstruct))
+
+            with phase(request, 'query'):
+                session.add_all([obj for obj in objs if obj is not None])
+                session.flush()
+
+            with phase(request, 'dictify'):
+                response[self.collection] = [
+                    None if obj is None else self.create_schema.dictify(obj)
+                    for obj in objs
+                ]
+
+        except ValueError:
+            log.exception('Bad request.')
+            session.rollback()
+            status = 400
+
+        except IntegrityError:
+            # Items are flushed together: the whole batch is rolled back
+            # and answered with a single 409.
+            log.exception('Conflict.')
+            session.rollback()
+            statuses = None
+            status = 409
+
+        except Exception:
+            log.exception('Unknown error.')
+            session.rollback()
+            status = 500
+
+        else:
+            log.debug('Bulk creation succeed.')
+            status = self.get_bulk_status(statuses, 201)
+            with phase(request, 'commit'):
+                session.commit()
+
+        finally:
+            request.response.status = status
+
+        if statuses is not None:
+            response['meta'] = {'statuses': statuses}
+
+        return response
+
+    def get_many_params(self, request, schema):
+        items = request.json_body.get(self.collection)
+        if not isinstance(items, list):
+            raise ValueError('{} must be a list.'.format(self.collection))
+
+        return [self.filter_params(item, schema)
+                if isinstance(item, dict) else item
+                for item in items]
+
+    def get_bulk_status(self, statuses, success):
+        failures = set([s['status'] for s in statuses
+                        if s['status'] != success])
+        if not failures:
+            return success
+
+        elif any(s['status'] == success for s in statuses):
+            # Multi-Status: some items succeed, others fail.
+            return 207
+
+        return min(failures)
+
+    def deserialize_partial(self, schema, params):
+        """ Return ``params`` deserialized by the nodes of ``schema``
+        they carry, ignoring the missing ones.
+        """
+        appstruct = {}
+        error = None
+        for pos, node in enumerate(schema.children):
+            if node.name not in params:
+                continue
+
+            try:
+                appstruct[node.name] = node.deserialize(params[node.name])
+
+            except colander.Invalid as e:
+                if error is None:
+                    error = colander.Invalid(schema)
+
+                error.add(e, pos)
+
+        if error is not None:
+            raise error
+
+        return appstruct
+
+    def get_primary_key(self):
+        inspector = inspect(self.cls)
+        if len(inspector.primary_key) > 1:
+            msg = 'Multiple primary keys are not supported'
+            raise NotImplementedError(msg)
+
+        return inspector.get_property_by_column(inspector.primary_key[0]).key
+
+    def get_many(self, session, ids, chunk_size=500):
+        """ Return objects with PK in ``ids`` by str(PK), using IN queries.
+        """
+        key = self.get_primary_key()
+        attr = getattr(self.cls, key)
+        objs = {}
+        for i in range(0, len(ids), chunk_size):
+            query = session.query(self.cls)\
+                           .filter(attr.in_(ids[i:i + chunk_size]))
+            objs.update((str(getattr(obj, key)), obj) for obj in query)
+
+        return objs
+
     def read(self, context, request):
 
         response = {}
 
         try:
-            session = self.session or getattr(request, self.db_session_key)
-            params = self.get_read_params(request)
-            obj = super(EmberDataBase, self).read(session, **params)
-            response[self.element] = self.read_schema.dictify(obj)
+            session = self.get_session(request)
+            with phase(request, 'validate'):
+                params = self.get_read_params(request)
 
-        except colander.Invalid:
+            with phase(request, 'query'):
+                obj = self.read_object(session, **params)
+
+            etag, last_modified = get_validators([obj])
+            if etag is not None:
+                check_not_modified(request, etag, last_modified)
+
+            serializer = self.get_serializer(self.read_schema)
+            with phase(request, 'dictify'):
+                response[self.element] = serializer(obj)
+
+            if etag is None:
+                check_not_modified(request, hash_payload(response))
+
+        except HTTPNotModified as e:
+            log.debug('Not modified.')
+            session.commit()
+            status = 304
+            response = e
+
+        except (colander.Invalid, KeyError):
             log.exception('Bad request.')
             session.rollback()
             status = 400
@@ -97,6 +344,40 @@ class EmberDataBase(crudalchemy.Base):
 
         return response
 
+    def read_object(self, session, **pks):
+        ident = self.get_ident(pks)
+        if self.object_cache is None:
+            obj = self.statement_cache.get(session, self.cls, ident)
+
+        else:
+            obj = self.object_cache.get(session, self.cls, ident,
+                                        self.statement_cache.get)
+
+        if obj is None:
+            msg = '{} {} not found.'.format(self.cls.__name__, pks)
+            raise NoResultFound(msg)
+
+        return obj
+
+    def get_ident(self, pks):
+        inspector = inspect(self.cls)
+        return tuple([pks[inspector.get_property_by_column(c).key]
+                      for c in inspector.primary_key])
+
+    def invalidate_objects(self, idents):
+        # Called once changes are committed: a failing cache must not
+        # turn them into errors, stale entries expire with their TTL.
+        if self.object_cache is None:
+            return
+
+        try:
+            for ident in idents:
+                self.object_cache.invalidate(self.cls, ident)
+
+        except Exception:
+            log.exception('Invalidation of %s %s failed.',
+                          self.cls.__name__, idents)
+
     def get_read_params(self, request):
         return self.get_params(request, self.read_schema)
 
@@ -105,13 +386,57 @@ class EmberDataBase(crudalchemy.Base):
         response = {}
 
         try:
-            session = self.session or getattr(request, self.db_session_key)
-            params = self.get_search_params(request)
-            items = [self.read_schema.dictify(o)
-                     for o in super(EmberDataBase, self).search(session, **params)]
-            response[self.collection] = items
+            session = self.get_session(request)
+            with phase(request, 'validate'):
+                params = self.get_search_params(request)
 
-        except colander.Invalid:
+            with phase(request, 'query'):
+                if 'limit' in params:
+                    objs, meta = self.do_keyset_search(session, **params)
+                    response['meta'] = meta
+
+                elif self.stream_json:
+                    # Fetched while the renderer writes the response.
+                    objs = self.stream_search(session, **params)
+
+                else:
+                    objs = self.get_search_query(session, **params).all()
+
+            if self.search_facets or self.search_aggregates:
+                meta = response.setdefault('meta', {})
+                with phase(request, 'facets'):
+                    meta.update(self.get_search_facets(session, **params))
+
+            if isinstance(objs, list):
+                etag, last_modified = get_validators(objs,
+                                                     response.get('meta'))
+
+            else:
+                # Streamed rows can be iterated only once.
+                etag = last_modified = None
+
+            if etag is not None:
+                check_not_modified(request, etag, last_modified)
+
+            serializer = self.get_serializer(self.read_schema)
+            if self.stream_json:
+                # Serialized while the renderer writes the response.
+                response[self.collection] = serializer.iter(objs)
+
+            else:
+                with phase(request, 'dictify'):
+                    response[self.collection] = serializer.many(objs)
+
+                if etag is None:
+                    check_not_modified(request, hash_payload(response))
+
+        except HTTPNotModified as e:
+            log.debug('Not modified.')
+            session.commit()
+            status = 304
+            response = e
+
+        except (colander.Invalid, ValueError):
             log.exception('Bad request.')
             session.rollback()
             status = 400
@@ -136,21 +461,140 @@ class EmberDataBase(crudalchemy.Base):
         query = request.params.get('query')
         if not query is None:
             query = json.loads(query)
-            criterions = query.get('criterions', [])
-            params = {}
-            params['criterions'] = tuple([getattr(getattr(self.cls,
-                                                          c['attr']),
-                                                  c['comparator'])(c['value'])
-                                          for c in criterions])
+            criterions, order_by, values = self.query_compiler.compile(query)
+            params['criterions'] = criterions
+            params['order_by'] = order_by
+            params['params'] = values
 
             orderby = query.get('orderby', [])
-            params['order_by'] = tuple([getattr(getattr(self.cls,
-                                                       c['attr']),
-                                               c['order'])()
-                                       for c in orderby])
+            if 'limit' in query or 'cursor' in query:
+                # Keyset pagination sorts by the first order clause only.
+                params['limit'] = int(query.get('limit', 25))
+                params['cursor'] = query.get('cursor')
+                if orderby:
+                    params['sort'] = (orderby[0]['attr'],
+                                      orderby[0].get('order', 'asc'))
 
         return params
 
+    def stream_search(self, session, **params):
+        """ Yield search results fetched in a session of their own.
+
+        Rows are fetched after the view returned, when the request
+        session may be committed or closed already, e.g. by pyramid_tm
+        or a finished callback: they are loaded in a new session bound
+        as ``session``, closed once rows are written or the response is
+        closed.
+        """
+        stream_session = Session(bind=session.get_bind(self.cls))
+        try:
+            query = self.get_search_query(stream_session, streaming=True,
+                                          **params)
+            for obj in query.yield_per(self.stream_chunk_size):
+                yield obj
+
+        finally:
+            stream_session.close()
+
+    def get_search_query(self, session, criterions=(), order_by=(),
+                         params=None, streaming=False, extra=(), **kw):
+        fields = self.get_search_fields(extra)
+        if fields:
+            query = session.query(*[getattr(self.cls, f) for f in fields])
+
+        elif self.stream_json:
+            # Relationships are serialized after the view returns: load
+            # them now, but collections of rows fetched with yield_per
+            # (``streaming``) which cannot be eager loaded.
+            query = session.query(self.cls)
+            serializer = self.get_serializer(self.read_schema)
+            plan = get_search_metadata(self.cls).get_load_plan(
+                serializer.relationships, streaming=streaming)
+            query = query.options(*plan.options)
+
+        else:
+            query = session.query(self.cls)
+
+        if criterions:
+            query = query.filter(and_(*criterions))
+
+        if order_by:
+            query = query.order_by(*order_by)
+
+        if params:
+            query = query.params(**params)
+
+        return query
+
+    def get_search_facets(self, session, criterions=(), params=None, **kw):
+        query = session.query(self.cls)
+        if criterions:
+            query = query.filter(and_(*criterions))
+
+        facets, aggregates = compute_facets(query,
+                                            self.cls,
+                                            self.search_facets,
+                                            self.search_aggregates,
+                                            params)
+        return {'facets': {name: [[value, count] for value, count in counts]
+                           for name, counts in facets.items()},
+                'aggregates': {name: {function: None if value is None
+                                      else float(value)
+                                      for function, value in values.items()}
+                               for name, values in aggregates.items()}}
+
+    def get_schema_fields(self, schema):
+        r = schema.registry
+        return [key for key in r.attrs
+                if key not in r.excludes and
+                (not r.includes or key in r.includes)]
+
+    def get_serializer(self, schema):
+        try:
+            return self.serializers[id(schema)]
+
+        except KeyError:
+            fields = self.get_schema_fields(schema)
+            serializer = Serializer(self.cls, fields)
+            self.serializers[id(schema)] = serializer
+            return serializer
+
+    def warmup(self, session_factory=None):
+        """ Build now what first requests would: mappers, serializers
+        and the search projection. Return build times by step.
+
+        Searches are not baked: ``session_factory`` is not used.
+        """
+        schemas = (self.create_schema, self.read_schema,
+                   self.update_schema, self.delete_schema)
+        steps = [('mappers', configure_mappers),
+                 ('serializers', lambda: [self.get_serializer(schema)
+                                          for schema in schemas]),
+                 ('projection', self.get_search_fields)]
+        return time_steps(steps)
+
+    def get_search_fields(self, extra=()):
+        if not self.search_projection:
+            return None
+
+        keys = self.get_schema_fields(self.read_schema)
+        fields, plain = get_projection(self.cls, keys, extra)
+        return fields if plain else None
+
+    def do_keyset_search(self, session, limit, cursor=None, sort=(None, 'asc'),
+                         criterions=(), order_by=(), params=None):
+        # Cursors are built from the sort keys: always select them.
+        extra = get_keyset_keys(self.cls, sort[0], cursor)
+        query = self.get_search_query(session, criterions, params=params,
+                                      extra=extra)
+        objs, previous, next_ = search_with_keyset(query,
+                                                   self.cls,
+                                                   sort[0],
+                                                   sort[1],
+                                                   limit,
+                                                   cursor)
+        return objs, {'previous': previous, 'next': next_}
+
     def update(self, context, request):
 
         # NOTE: PKs update is not supported.
@@ -159,11 +603,17 @@ class EmberDataBase(crudalchemy.Base):
         response = {}
 
         try:
-            session = self.session or getattr(request, self.db_session_key)
-            params = self.get_update_params(request)
-            obj = super(EmberDataBase, self).update(session, **params)
-            session.flush()
-            response[self.element] = self.update_schema.dictify(obj)
+            session = self.get_session(request)
+            with phase(request, 'validate'):
+                params = self.get_update_params(request)
+
+            with phase(request, 'query'):
+                obj = super(EmberDataBase, self).update(session, **params)
+                session.flush()
+
+            ident = self.get_ident(params)
+            with phase(request, 'dictify'):
+                response[self.element] = self.update_schema.dictify(obj)
 
         except colander.Invalid:
             log.exception('Bad request.')
@@ -183,7 +633,10 @@ class EmberDataBase(crudalchemy.Base):
         else:
             log.debug('Update succeed.')
             status = 200
-            session.commit()
+            with phase(request, 'commit'):
+                session.commit()
+
+            self.invalidate_objects([ident])
 
         finally:
             request.response.status = status
@@ -193,22 +646,150 @@ class EmberDataBase(crudalchemy.Base):
     def get_update_params(self, request):
         params = request.json_body.get(self.element, {})
         log.debug('Params: %s' % params)
-        r = self.update_schema.registry
-        for key in r.attrs:
-            if key in r.excludes or (r.includes and key not in r.includes):
-                params.pop(key)
+        params = self.filter_params(params, self.update_schema)
         log.debug('Params: %s' % params)
         return params
 
+    def get_bulk_update_attrs(self):
+        """ Return the attributes update_many may send as bulk mappings.
+        Bulk updates skip the version counter and leave onupdate values
+        unknown to the objects: such mappers always use the unit of work.
+        """
+        mapper = inspect(self.cls)
+        if mapper.version_id_col is not None or any(
+                column.onupdate is not None or
+                column.server_onupdate is not None
+                for column in mapper.columns):
+            return set()
+
+        return set(mapper.column_attrs.keys())
+
+    def update_many(self, context, request):
+
+        # Bulk update, as sent by Ember Data bulk commit:
+        # PUT /accounts/bulk {"accounts": [{"id": ..., ...}, ...]}
+        # Objects are loaded with IN queries and updated within a single
+        # commit: items only change the attributes they carry. Column only
+        # changes are sent with bulk_update_mappings, one executemany per
+        # set of attributes, and applied to the loaded objects as committed
+        # values; anything else goes through the unit of work.
+        # PKs update is not supported.
+
+        response = {}
+        statuses = []
+
+        try:
+            session = self.get_session(request)
+            items = self.get_many_params(request, self.update_schema)
+            key = self.get_primary_key()
+            ids = [item.get(key) if isinstance(item, dict) else None
+                   for item in items]
+            found = self.get_many(session, [id_ for id_ in ids
+                                            if id_ is not None])
+            bulk = self.get_bulk_update_attrs()
+            mappings = []
+            updates = []
+            objs = []
+            for params, id_ in zip(items, ids):
+                obj = None if id_ is None else found.get(str(id_))
+                if id_ is None:
+                    errors = {key: 'Required'}
+                    statuses.append({'status': 400, 'errors': errors})
+
+                elif obj is None:
+                    statuses.append({'status': 404})
+
+                else:
+                    try:
+                        appstruct = self.deserialize_partial(
+                            self.update_schema, params)
+
+                    except colander.Invalid as e:
+                        statuses.append({'status': 400,
+                                         'errors': e.asdict()})
+                        obj = None
+
+                    else:
+                        appstruct.pop(key, None)
+                        if appstruct and set(appstruct) <= bulk:
+                            mapping = dict(appstruct)
+                            mapping[key] = getattr(obj, key)
+                            mappings.append(mapping)
+                            updates.append((obj, appstruct))
+
+                        else:
+                            for attr, value in appstruct.items():
+                                setattr(obj, attr, value)
+
+                        statuses.append({'status': 200})
+
+                objs.append(obj)
+
+            with phase(request, 'query'):
+                if mappings:
+                    session.bulk_update_mappings(self.cls, mappings)
+
+                session.flush()
+
+            for obj, appstruct in updates:
+                for attr, value in appstruct.items():
+                    set_committed_value(obj, attr, value)
+
+            with phase(request, 'dictify'):
+                response[self.collection] = [
+                    None if obj is None else self.update_schema.dictify(obj)
+                    for obj in objs
+                ]
+
+        except ValueError:
+            log.exception('Bad request.')
+            session.rollback()
+            status = 400
+
+        except IntegrityError:
+            # Items are flushed together: the whole batch is rolled back
+            # and answered with a single 409.
+            log.exception('Conflict.')
+            session.rollback()
+            statuses = None
+            status = 409
+
+        except Exception:
+            log.exception('Unknown error.')
+            session.rollback()
+            status = 500
+
+        else:
+            log.debug('Bulk update succeed.')
+            status = self.get_bulk_status(statuses, 200)
+            with phase(request, 'commit'):
+                session.commit()
+
+            self.invalidate_objects([(id_,) for id_ in ids
+                                     if id_ is not None])
+
+        finally:
+            request.response.status = status
+
+        if statuses is not None:
+            response['meta'] = {'statuses': statuses}
+
+        return response
+
     def delete(self, context, request):
 
         response = {}
 
         try:
-            session = self.session or getattr(request, self.db_session_key)
-            params = self.get_delete_params(request)
-            super(EmberDataBase, self).delete(session, **params)
-            session.flush()
+            session = self.get_session(request)
+            with phase(request, 'validate'):
+                params = self.get_delete_params(request)
+
+            with phase(request, 'query'):
+                super(EmberDataBase, self).delete(session, **params)
+                session.flush()
+
+            ident = self.get_ident(params)
 
         except colander.Invalid:
             log.exception('Bad request.')
@@ -228,7 +809,10 @@ class EmberDataBase(crudalchemy.Base):
         else:
             log.debug('Delete succeed.')
             status = 204
-            session.commit()
+            with phase(request, 'commit'):
+                session.commit()
+
+            self.invalidate_objects([ident])
 
         finally:
             request.response.status = status
@@ -238,6 +822,93 @@ class EmberDataBase(crudalchemy.Base):
     def get_delete_params(self, request):
         return self.get_params(request, self.delete_schema)
 
+    def delete_many(self, context, request):
+
+        # Bulk delete, as sent by Ember Data bulk commit:
+        # DELETE /accounts/bulk {"accounts": [id, ...]}
+        # Existing rows are deleted with a single DELETE ... WHERE IN,
+        # unless relationships cascade deletes through the ORM.
+
+        response = {}
+        statuses = []
+
+        try:
+            session = self.get_session(request)
+            key = self.get_primary_key()
+            ids = []
+            for item in self.get_many_params(request, self.delete_schema):
+                if not isinstance(item, dict):
+                    item = {key: item}
+
+                try:
+                    ids.append(self.delete_schema.deserialize(item)[key])
+
+                except colander.Invalid as e:
+                    statuses.append({'status': 400, 'errors': e.asdict()})
+                    ids.append(None)
+
+                else:
+                    statuses.append({'status': 200})
+
+            valid = [id_ for id_ in ids if id_ is not None]
+            attr = getattr(self.cls, key)
+            cascade = any(prop.cascade.delete
+                          for prop in inspect(self.cls).relationships)
+            if cascade:
+                found = self.get_many(session, valid)
+                for obj in found.values():
+                    session.delete(obj)
+
+            else:
+                found = set()
+                for i in range(0, len(valid), 500):
+                    chunk = valid[i:i + 500]
+                    found.update(str(row[0]) for row in
+                                 session.query(attr).filter(attr.in_(chunk)))
+                    session.query(self.cls)\
+                           .filter(attr.in_(chunk))\
+                           .delete(synchronize_session=False)
+
+            for item, id_ in zip(statuses, ids):
+                if id_ is not None and str(id_) not in found:
+                    item['status'] = 404
+
+            session.flush()
+
+        except ValueError:
+            log.exception('Bad request.')
+            session.rollback()
+            status = 400
+
+        except IntegrityError:
+            # Items are flushed together: the whole batch is rolled back
+            # and answered with a single 409.
+            log.exception('Conflict.')
+            session.rollback()
+            statuses = None
+            status = 409
+
+        except Exception:
+            log.exception('Unknown error.')
+            session.rollback()
+            status = 500
+
+        else:
+            log.debug('Bulk delete succeed.')
+            status = self.get_bulk_status(statuses, 200)
+            with phase(request, 'commit'):
+                session.commit()
+
+            self.invalidate_objects([(id_,) for id_ in valid])
+
+        finally:
+            request.response.status = status
+
+        if statuses is not None:
+            response['meta'] = {'statuses': statuses}
+
+        return response
+
     def get_params(self, request, schema):
 
         params = {}
@@ -259,38 +930,72 @@ class EmberDataBase(crudalchemy.Base):
 
         return params
 
+    def check_renderer(self, registry):
+        factory = registry.queryUtility(IRendererFactory, name=self.renderer)
+        if self.stream_json and not isinstance(factory, StreamingJSON):
+            msg = '{}.stream_json needs a StreamingJSON renderer, not {!r}.'
+            raise ConfigurationError(msg.format(type(self).__name__,
+                                                self.renderer))
+
     def setup_routing(self, config, prefix=''):
 
+        # Checked once renderers added by the configuration are known.
+        config.action(None, self.check_renderer, (config.registry,))
+
         route_name = '{}_create'.format(self.element)
-        renderer = 'json'
+        renderer = self.renderer
         config.add_route(route_name,
                          '{}/{}'.format(prefix, self.collection),
                          request_method='POST')
-        config.add_view(self.create, route_name=route_name, renderer=renderer)
+        config.add_view(self.create, route_name=route_name, renderer=renderer,
+                        decorator=timed(self.cls, 'create'))
+
+        # Bulk routes must be added before the item ones: {id} matches bulk.
+        route_name = '{}_update_bulk'.format(self.collection)
+        config.add_route(route_name,
+                         '{}/{}/bulk'.format(prefix, self.collection),
+                         request_method='PUT')
+        config.add_view(self.update_many,
+                        route_name=route_name,
+                        renderer=renderer,
+                        decorator=timed(self.cls, 'update'))
+
+        route_name = '{}_delete_bulk'.format(self.collection)
+        config.add_route(route_name,
+                         '{}/{}/bulk'.format(prefix, self.collection),
+                         request_method='DELETE')
+        config.add_view(self.delete_many,
+                        route_name=route_name,
+                        renderer=renderer,
+                        decorator=timed(self.cls, 'delete'))
 
         route_name = '{}_read'.format(self.element)
         config.add_route(route_name,
                          '{}/{}/{}'.format(prefix, self.collection, '{id}'),
                          request_method='GET')
-        config.add_view(self.read, route_name=route_name, renderer=renderer)
+        config.add_view(self.read, route_name=route_name, renderer=renderer,
+                        decorator=timed(self.cls, 'read'))
 
         route_name = '{}_search'.format(self.collection)
         config.add_route(route_name,
                          '{}/{}'.format(prefix, self.collection),
                          request_method='GET')
-        config.add_view(self.search, route_name=route_name, renderer=renderer)
+        config.add_view(self.search, route_name=route_name, renderer=renderer,
+                        decorator=timed(self.cls, 'search'))
 
         route_name = '{}_update'.format(self.element)
         config.add_route(route_name,
                          '{}/{}/{}'.format(prefix, self.collection, '{id}'),
                          request_method='PUT')
-        config.add_view(self.update, route_name=route_name, renderer=renderer)
+        config.add_view(self.update, route_name=route_name, renderer=renderer,
+                        decorator=timed(self.cls, 'update'))
 
         route_name = '{}_delete'.format(self.element)
         config.add_route(route_name,
                          '{}/{}/{}'.format(prefix, self.collection, '{id}'),
                          request_method='DELETE')
-        config.add_view(self.delete, route_name=route_name, renderer=renderer)
+        config.add_view(self.delete, route_name=route_name, renderer=renderer,
+                        decorator=timed(self.cls, 'delete'))
 
         """ FIXME
         PUT /accounts => 405 method not allowed
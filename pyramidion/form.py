@@ -11,17 +11,10 @@ from deform.widget import (HiddenWidget,
                            SequenceWidget)
 from deform_bootstrap.widget import (ChosenMultipleWidget,
                                      ChosenSingleWidget)
+from .search import (CursorValidator,
+                     get_search_metadata)
 from deformalchemy import SQLAlchemyForm
-from sqlalchemy import (Boolean,
-                        Date,
-                        DateTime,
-                        Enum,
-                        Float,
-                        Integer,
-                        Numeric,
-                        String,
-                        Time,
-                        inspect)
+from sqlalchemy import inspect
 import colander
 
 
@@ -29,7 +22,8 @@ class SQLAlchemySearchSchemaNode(SQLAlchemySchemaNode):
 
     def __init__(self, class_, includes=None,
                  excludes=None, overrides=None, unknown='raise'):
-        self.comparators = {}
+        self.metadata = get_search_metadata(class_)
+        self.comparators = self.metadata.comparators
         self.order_by_values = []
         SQLAlchemySchemaNode.__init__(self,
                                       class_,
@@ -52,7 +46,7 @@ class SQLAlchemySearchSchemaNode(SQLAlchemySchemaNode):
                                     missing=25,
                                     default=25,
                                     validator=colander.Range(min=1))
-        values = [prop.key for prop in self.inspector.column_attrs]
+        values = list(self.metadata.columns)
         order_by = colander.SchemaNode(colander.String(),
                                        name='order_by',
                                        title='Order By',
@@ -72,6 +66,13 @@ class SQLAlchemySearchSchemaNode(SQLAlchemySchemaNode):
                                         title='Intersect Criterions',
                                         missing=True,
                                         default=True)
+        cursor = colander.SchemaNode(colander.String(),
+                                     name='cursor',
+                                     title='Cursor',
+                                     missing=colander.null,
+                                     default=colander.null,
+                                     validator=CursorValidator(
+                                         self.metadata.cls))
         self.order_by_values = values
         self.direction_values = direction_values
         self.add(start)
@@ -79,6 +80,7 @@ class SQLAlchemySearchSchemaNode(SQLAlchemySchemaNode):
         self.add(order_by)
         self.add(direction)
         self.add(intersect)
+        self.add(cursor)
 
     def get_schema_from_column(self, prop, overrides):
         col_node = SQLAlchemySchemaNode.get_schema_from_column(self,
@@ -87,58 +89,13 @@ class SQLAlchemySearchSchemaNode(SQLAlchemySchemaNode):
         col_node.missing = colander.null
         col_node.default = colander.null
         name = prop.key
-        column = prop.columns[0]
-        column_type = getattr(column.type, 'impl', column.type)
-        type_ = colander.String()
-        if isinstance(column_type, (Boolean, Enum)):
-            comparators = [('', ''),
-                           ('__eq__', '=='),
-                           ('__neq__', '!=')]
-            default_comp = '__eq__'
-
-        elif isinstance(column_type, String):
-            comparators = [('', ''),
-                           ('like', 'like'),
-                           ('ilike', 'ilike')]
-            default_comp = 'like'
-
-        elif isinstance(column_type, (Date,
-                                      DateTime,
-                                      Time)):
-            comparators = [('', ''),
-                           ('__lt__', '<'),
-                           ('__lte__', '<='),
-                           ('__eq__', '=='),
-                           ('__neq__', '!='),
-                           ('__gte__', '>='),
-                           ('__gt__', '>')]
-            default_comp = '__gte__'
-
-        elif isinstance(column_type, (Float,
-                                      Integer,
-                                      Numeric)):
-            comparators = [('', ''),
-                           ('__lt__', '<'),
-                           ('__lte__', '<='),
-                           ('__eq__', '=='),
-                           ('__neq__', '!='),
-                           ('__gte__', '>='),
-                           ('__gt__', '>')]
-            default_comp = '__eq__'
-
-        else:
+        if name not in self.metadata.comparators:
+            column_type = prop.columns[0].type
             raise NotImplementedError('Unknown type: %s' % column_type)
 
-        self.comparators[name] = comparators
-        validator = colander.OneOf([v[0] for v in comparators if v[0]])
         # Create right node!
         col_node.title = col_node.title.title()
-        comp_node = colander.SchemaNode(colander.String(),
-                                        name='comparator',
-                                        title='Comparator',
-                                        missing=default_comp,
-                                        default=default_comp,
-                                        validator=validator)
+        comp_node = self.get_comparator_schema(name)
         mapping_name = '{}_criterion'.format(name)
         mapping_title = ''  # '{} Criterion'.format(title)
         return colander.SchemaNode(colander.Mapping(),
@@ -147,6 +104,15 @@ class SQLAlchemySearchSchemaNode(SQLAlchemySchemaNode):
                                    name=mapping_name,
                                    title=mapping_title)
 
+    def get_comparator_schema(self, name):
+        default = self.metadata.defaults[name]
+        return colander.SchemaNode(colander.String(),
+                                   name='comparator',
+                                   title='Comparator',
+                                   missing=default,
+                                   default=default,
+                                   validator=self.metadata.validators[name])
+
     def get_schema_from_relationship(self, prop, overrides):
         rel_node = SQLAlchemySchemaNode.get_schema_from_relationship(self,
                                                                      prop,
@@ -155,33 +121,12 @@ class SQLAlchemySearchSchemaNode(SQLAlchemySchemaNode):
           return None
 
         name = prop.key
-        if prop.uselist:
-            comparators = [('', ''),
-                           ('contains', 'contains'),
-                           ('notcontains', 'not contains'),
-                           ('__eq__', '=='),
-                           ('__neq__', '!=')]
-            default_comp = '__eq__'
-
-        else:
-            comparators = [('', ''),
-                           ('__eq__', '=='),
-                           ('__neq__', '!=')]
-            default_comp = '__eq__'
-
-        self.comparators[name] = comparators
-        validator = colander.OneOf([v[0] for v in comparators if v[0]])
         # Create the right node!
         rel_node.name = 'value'
         rel_node.title = rel_node.title.title()
-        comp_node = colander.SchemaNode(colander.String(),
-                                        name='comparator',
-                                        title='Comparator',
-                                        missing=default_comp,
-                                        default=default_comp,
-                                        validator=validator)
+        comp_node = self.get_comparator_schema(name)
         mapping_name = '{}_criterion'.format(name)
-        mapping_title = '{} Criterion'.format(title)
+        mapping_title = '{} Criterion'.format(name.title())
         return colander.SchemaNode(colander.Mapping(),
                                    rel_node,
                                    comp_node,
@@ -226,23 +171,24 @@ class SQLAlchemySearchForm(SQLAlchemyForm):
                                             excludes=excludes,
                                             overrides=overrides)
         self.inspector = inspect(class_)
-        for prop in self.inspector.attrs:
+        metadata = schema.metadata
+        for name in metadata.attrs:
 
-            name = prop.key
             map_name = '{}_criterion'.format(name)
             if map_name not in schema:
                 continue
 
-            try:
-                getattr(self.inspector.column_attrs, name)
+            prop = self.inspector.attrs[name]
+            if name in metadata.columns:
                 factory = 'get_widget_from_column'
+                value_name = name
 
-            except AttributeError:
-                getattr(self.inspector.relationships, name)
+            else:
                 factory = 'get_widget_from_relationship'
+                value_name = 'value'
 
             mapping_schema = schema[map_name]
-            value_schema = mapping_schema[name]
+            value_schema = mapping_schema[value_name]
             if value_schema.widget is None:
                 widget = getattr(self, factory)(prop)
                 value_schema.widget = widget
@@ -282,6 +228,7 @@ class SQLAlchemySearchForm(SQLAlchemyForm):
             widget = SelectWidget(values=values)
 
         intersect.widget = widget
+        schema['cursor'].widget = HiddenWidget()
 
         super(SQLAlchemyForm, self).__init__(schema, **kw)
 
@@ -291,24 +238,27 @@ class SQLAlchemySearchForm(SQLAlchemyForm):
             widget = ChosenSingleWidget(values=values)
 
         elif self.bootstrap:
-            widget = ChosenMultiWidget(values=values)
+            widget = ChosenMultipleWidget(values=values)
 
         else:
             widget = SelectWidget(values=values, multiple=multiple)
 
         return widget
 
-    def populate_widgets(self, session):
+    def populate_widgets(self, session, cache=None):
 
-        for prop in self.inspector.attrs:
+        for name in self.schema.metadata.attrs:
 
-            name = prop.key
             seq_key = '{}_criterions'.format(name)
             map_key = '{}_criterion'.format(name)
             node_key = 'value'
             widget = self.schema[seq_key][map_key][node_key].widget
             try:
-                widget.populate(session)
+                if cache is None:
+                    widget.populate(session)
+
+                else:
+                    cache.populate(widget, session)
 
             except AttributeError:
                 continue
@@ -324,23 +274,24 @@ class SQLAlchemySimpleSearchForm(SQLAlchemyForm):
                                             excludes=excludes,
                                             overrides=overrides)
         self.inspector = inspect(class_)
-        for prop in self.inspector.attrs:
+        metadata = schema.metadata
+        for name in metadata.attrs:
 
-            name = prop.key
             map_name = '{}_criterion'.format(name)
             if map_name not in schema:
                 continue
 
-            try:
-                getattr(self.inspector.column_attrs, name)
+            prop = self.inspector.attrs[name]
+            if name in metadata.columns:
                 factory = 'get_widget_from_column'
+                value_name = name
 
-            except AttributeError:
-                getattr(self.inspector.relationships, name)
+            else:
                 factory = 'get_widget_from_relationship'
+                value_name = 'value'
 
             mapping_schema = schema[map_name]
-            value_schema = mapping_schema[name]
+            value_schema = mapping_schema[value_name]
             if value_schema.widget is None:
                 widget = getattr(self, factory)(prop)
                 value_schema.widget = widget
@@ -356,6 +307,7 @@ class SQLAlchemySimpleSearchForm(SQLAlchemyForm):
         schema['order_by'].widget = HiddenWidget()
         schema['direction'].widget = HiddenWidget()
         schema['intersect'].widget = HiddenWidget()
+        schema['cursor'].widget = HiddenWidget()
 
         # It is needed parent of __SQLAlchemyForm__ !!!
         super(SQLAlchemyForm, self).__init__(schema, **kw)
@@ -363,14 +315,23 @@ class SQLAlchemySimpleSearchForm(SQLAlchemyForm):
     def get_comparator_widget(self, values, multiple=False):
         return HiddenWidget()
 
-    def populate_widgets(self, session):
+    def populate_widgets(self, session, cache=None):
 
-        for prop in self.inspector.attrs:
+        for name in self.schema.metadata.attrs:
 
-            name = prop.key
             map_key = '{}_criterion'.format(name)
             try:
-                self.schema[map_key][name].widget.populate(session)
+                mapping_schema = self.schema[map_key]
+                if name not in mapping_schema:
+                    # Relationships value node.
+                    name = 'value'
+
+                widget = mapping_schema[name].widget
+                if cache is None:
+                    widget.populate(session)
+
+                else:
+                    cache.populate(widget, session)
 
             except (KeyError, AttributeError) as e:
                 continue
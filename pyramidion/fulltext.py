@@ -0,0 +1,176 @@
+# Copyright (C) 2012 the Pyramidion authors and contributors
+# <see AUTHORS file>
+#
+# This module is part of Pyramidion and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+
+""" Full-text search criterions using database native indexes.
+
+Columns are declared full-text with declare_fulltext_index, which
+creates along with the table:
+
+ * PostgreSQL: a GIN index on to_tsvector(config, column);
+ * SQLite: a FTS5 external content table '<table>_fts', kept in sync by
+   triggers.
+
+fulltext_match(column, query) compiles to an index lookup on those
+backends, and to a case insensitive LIKE on other backends or columns
+not declared full-text.
+"""
+
+from sqlalchemy import (DDL,
+                        String,
+                        event,
+                        func,
+                        inspect,
+                        literal_column)
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import (ColumnClause,
+                                       FunctionElement,
+                                       type_coerce)
+from sqlalchemy.types import (Boolean,
+                              TypeDecorator)
+
+__all__ = ['fulltext_match', 'declare_fulltext_index',
+           'create_fulltext_index', 'get_fulltext_ddl']
+
+# Text search configuration used when none is given.
+DEFAULT_CONFIG = 'simple'
+
+
+class fulltext_match(FunctionElement):
+    """ Criterion true when ``column`` text matches all words in ``query``.
+    """
+    type = Boolean()
+    name = 'fulltext_match'
+
+
+class FTS5Query(TypeDecorator):
+    """ Turn plain text into a FTS5 query matching all its words. """
+
+    impl = String
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+
+        return ' '.join(['"{}"'.format(word.replace('"', '""'))
+                         for word in value.split()])
+
+
+def get_config(column):
+    config = column.info.get('fulltext')
+    if config is True:
+        return DEFAULT_CONFIG
+
+    return config
+
+
+@compiles(fulltext_match)
+def compile_fulltext_match(element, compiler, **kw):
+    column, query = list(element.clauses)
+    return compiler.process(func.lower(column).contains(func.lower(query)),
+                            **kw)
+
+
+@compiles(fulltext_match, 'postgresql')
+def compile_fulltext_match_postgresql(element, compiler, **kw):
+    column, query = list(element.clauses)
+    config = get_config(column)
+    if not config:
+        return compile_fulltext_match(element, compiler, **kw)
+
+    # Same expression as the GIN index, so that the planner uses it.
+    config = literal_column("'{}'".format(config.replace("'", "''")))
+    return '{} @@ {}'.format(
+        compiler.process(func.to_tsvector(config, column), **kw),
+        compiler.process(func.plainto_tsquery(config, query), **kw))
+
+
+@compiles(fulltext_match, 'sqlite')
+def compile_fulltext_match_sqlite(element, compiler, **kw):
+    column, query = list(element.clauses)
+    if not get_config(column):
+        return compile_fulltext_match(element, compiler, **kw)
+
+    preparer = compiler.preparer
+    fts = preparer.quote('{}_fts'.format(column.table.name))
+    rowid = ColumnClause('rowid', _selectable=column.table)
+    return '{} IN (SELECT rowid FROM {} WHERE {}.{} MATCH {})'.format(
+        compiler.process(rowid, **kw),
+        fts,
+        fts,
+        preparer.quote(column.name),
+        compiler.process(type_coerce(query, FTS5Query()), **kw))
+
+
+def get_columns(cls, keys):
+    mapper = inspect(cls)
+    return [mapper.get_property(key).columns[0] for key in keys]
+
+
+def get_fulltext_ddl(table, columns, dialect_name, config=DEFAULT_CONFIG):
+    """ Return the statements creating the full-text indexes of
+    ``columns`` of ``table`` on ``dialect_name``, if supported.
+    """
+    name = table.name
+    if dialect_name == 'postgresql':
+        return ["CREATE INDEX ix_{0}_{1}_fts ON {0} "
+                "USING gin (to_tsvector('{2}', {1}))".format(name,
+                                                             column.name,
+                                                             config)
+                for column in columns]
+
+    if dialect_name == 'sqlite':
+        cols = ', '.join([column.name for column in columns])
+        new = ', '.join(['new.{}'.format(column.name) for column in columns])
+        old = ', '.join(['old.{}'.format(column.name) for column in columns])
+        delete = ("INSERT INTO {0}_fts({0}_fts, rowid, {1}) "
+                  "VALUES ('delete', old.rowid, {2});").format(name, cols, old)
+        insert = ("INSERT INTO {0}_fts(rowid, {1}) "
+                  "VALUES (new.rowid, {2});").format(name, cols, new)
+        return ["CREATE VIRTUAL TABLE {0}_fts USING fts5({1}, "
+                "content='{0}', content_rowid='rowid')".format(name, cols),
+                "CREATE TRIGGER {0}_fts_ai AFTER INSERT ON {0} "
+                "BEGIN {1} END".format(name, insert),
+                "CREATE TRIGGER {0}_fts_ad AFTER DELETE ON {0} "
+                "BEGIN {1} END".format(name, delete),
+                "CREATE TRIGGER {0}_fts_au AFTER UPDATE ON {0} "
+                "BEGIN {1} {2} END".format(name, delete, insert),
+                "INSERT INTO {0}_fts({0}_fts) VALUES ('rebuild')".format(name)]
+
+    return []
+
+
+def declare_fulltext_index(cls, *keys, **kw):
+    """ Declare columns ``keys`` of ``cls`` full-text searchable.
+
+    The indexes are created after the table, e.g. by create_all; use
+    create_fulltext_index for tables existing already. Declare all the
+    columns of a table in one call: SQLite uses a single FTS5 table.
+    """
+    config = kw.pop('config', DEFAULT_CONFIG)
+    columns = get_columns(cls, keys)
+    for column in columns:
+        column.info['fulltext'] = config
+
+    table = columns[0].table
+    for dialect_name in ('postgresql', 'sqlite'):
+        for statement in get_fulltext_ddl(table, columns, dialect_name,
+                                          config):
+            ddl = DDL(statement)
+            event.listen(table,
+                         'after_create',
+                         ddl.execute_if(dialect=dialect_name))
+
+
+def create_fulltext_index(bind, cls, *keys, **kw):
+    """ Create the full-text indexes of columns ``keys`` of ``cls``. """
+    config = kw.pop('config', DEFAULT_CONFIG)
+    columns = get_columns(cls, keys)
+    for column in columns:
+        column.info['fulltext'] = config
+
+    for statement in get_fulltext_ddl(columns[0].table, columns,
+                                      bind.dialect.name, config):
+        bind.execute(DDL(statement))
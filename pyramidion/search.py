@@ -0,0 +1,915 @@
+# Copyright (C) 2012 the Pyramidion authors and contributors
+# <see AUTHORS file>
+#
+# This module is part of Pyramidion and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+
+from .cache import LRUCache
+from .fulltext import fulltext_match
+from collections import (OrderedDict,
+                         namedtuple)
+from decimal import Decimal
+from sqlalchemy import (Boolean,
+                        Date,
+                        DateTime,
+                        Enum,
+                        Float,
+                        Integer,
+                        Numeric,
+                        String,
+                        Time,
+                        and_,
+                        bindparam,
+                        cast,
+                        func,
+                        inspect,
+                        literal,
+                        null,
+                        or_,
+                        select,
+                        union_all)
+from sqlalchemy.orm import (joinedload,
+                            lazyload,
+                            load_only,
+                            noload,
+                            subqueryload)
+import base64
+import colander
+import datetime
+import json
+import logging
+import operator
+import threading
+
+__all__ = ['supports_window_functions', 'search_with_window',
+           'encode_cursor', 'decode_cursor', 'get_keyset_keys',
+           'search_with_keyset',
+           'LoadPlan', 'plan_eager_loads', 'get_projection', 'project',
+           'InvalidQuery', 'QuerySpecCompiler', 'SEARCH_COMPARATORS',
+           'search_criterion', 'SearchMetadata', 'get_search_metadata',
+           'compute_facets']
+
+try:
+    from sqlalchemy.orm import selectinload
+
+except ImportError:  # SQLAlchemy < 1.2
+    selectinload = None
+
+log = logging.getLogger(__file__)
+
+
+def supports_window_functions(dialect):
+    """ Return True if the backend understands ``count(*) OVER ()``.
+    """
+    if dialect.name == 'sqlite':
+        return dialect.dbapi.sqlite_version_info >= (3, 25)
+
+    if dialect.name == 'mysql':
+        version = tuple(dialect.server_version_info or ())
+        # is_mariadb since SQLAlchemy 1.4, MariaDB in version before.
+        if getattr(dialect, 'is_mariadb', None) or \
+                getattr(dialect, '_is_mariadb', None):
+            return version >= (10, 2)
+
+        return version >= (8,)
+
+    return True
+
+
+def _method(name):
+    return lambda attr, value: getattr(attr, name)(value)
+
+
+try:
+    bindparam('in', expanding=True)
+
+except TypeError:  # SQLAlchemy < 1.2: no IN with a single parameter.
+    EXPANDING_IN = False
+
+else:
+    EXPANDING_IN = True
+
+
+# Comparators of search schemas, by name.
+SEARCH_COMPARATORS = {'__eq__': operator.eq,
+                      '__neq__': operator.ne,
+                      '__lt__': operator.lt,
+                      '__lte__': operator.le,
+                      '__gte__': operator.ge,
+                      '__gt__': operator.gt,
+                      'like': _method('like'),
+                      'ilike': _method('ilike'),
+                      'contains': _method('contains'),
+                      'notcontains': lambda attr, value: ~attr.contains(value),
+                      'match': fulltext_match,
+                      # Made by SearchMetadata.merge.
+                      'in_': _method('in_'),
+                      'notin_': lambda attr, value: ~attr.in_(value),
+                      'between': lambda attr, value: attr.between(*value)}
+
+
+def search_criterion(attr, comparator, value):
+    compare = SEARCH_COMPARATORS.get(comparator)
+    if compare is None:
+        # e.g. relationships 'contains'.
+        return getattr(attr, comparator)(value)
+
+    return compare(attr, value)
+
+
+ORDERING_COMPARATORS = (('', ''),
+                        ('__lt__', '<'),
+                        ('__lte__', '<='),
+                        ('__eq__', '=='),
+                        ('__neq__', '!='),
+                        ('__gte__', '>='),
+                        ('__gt__', '>'))
+
+# (column types, comparators, default comparator), first match wins.
+COLUMN_COMPARATORS = (((Boolean, Enum),
+                       (('', ''), ('__eq__', '=='), ('__neq__', '!=')),
+                       '__eq__'),
+                      ((String,),
+                       (('', ''), ('like', 'like'), ('ilike', 'ilike')),
+                       'like'),
+                      ((Date, DateTime, Time),
+                       ORDERING_COMPARATORS,
+                       '__gte__'),
+                      ((Float, Integer, Numeric),
+                       ORDERING_COMPARATORS,
+                       '__eq__'))
+
+# Comparators of columns declared with fulltext.declare_fulltext_index.
+FULLTEXT_COMPARATORS = (('', ''),
+                        ('match', 'match'),
+                        ('like', 'like'),
+                        ('ilike', 'ilike'))
+
+RELATIONSHIP_COMPARATORS = (('', ''), ('__eq__', '=='), ('__neq__', '!='))
+
+COLLECTION_COMPARATORS = (('', ''),
+                          ('contains', 'contains'),
+                          ('notcontains', 'not contains'),
+                          ('__eq__', '=='),
+                          ('__neq__', '!='))
+
+
+class SearchMetadata(object):
+    """ Search comparators of a mapped class, by attribute name.
+
+    ``comparators`` hold (value, label) pairs as used by widgets,
+    ``validators`` the colander validators of the comparator nodes,
+    ``defaults`` their default and ``attrs`` the instrumented attributes
+    to compare. Properties of unsupported column types are missing.
+    Instances are shared: use get_search_metadata and do not change them.
+    """
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.load_plans = {}
+        self.comparators = {}
+        self.defaults = {}
+        self.validators = {}
+        self.attrs = OrderedDict()
+        inspector = inspect(cls)
+        self.columns = tuple([prop.key for prop in inspector.column_attrs])
+        for prop in inspector.attrs:
+            if prop.key in self.columns:
+                found = self.get_column_comparators(prop)
+
+            elif prop.key in inspector.relationships:
+                found = self.get_relationship_comparators(prop)
+
+            else:
+                found = None
+
+            if found is None:
+                continue
+
+            comparators, default = found
+            self.comparators[prop.key] = comparators
+            self.defaults[prop.key] = default
+            values = [value for value, label in comparators if value]
+            self.validators[prop.key] = colander.OneOf(values)
+            self.attrs[prop.key] = getattr(cls, prop.key)
+
+    def get_column_comparators(self, prop):
+        column = prop.columns[0]
+        if column.info.get('fulltext'):
+            return FULLTEXT_COMPARATORS, 'match'
+
+        column_type = getattr(column.type, 'impl', column.type)
+        for types, comparators, default in COLUMN_COMPARATORS:
+            if isinstance(column_type, types):
+                return comparators, default
+
+        return None
+
+    def get_relationship_comparators(self, prop):
+        if prop.uselist:
+            return COLLECTION_COMPARATORS, '__eq__'
+
+        return RELATIONSHIP_COMPARATORS, '__eq__'
+
+    def criterion(self, name, comparator, value):
+        if name in self.columns:
+            return search_criterion(self.attrs[name], comparator, value)
+
+        return relationship_criterion(self.attrs[name], comparator, value)
+
+    def merge(self, criteria, intersect=True):
+        """ Merge (name, comparator, value) criteria of a column.
+
+        Equality values of a column are alternatives: they are merged in
+        a single IN. When criteria are intersected, inequalities are
+        merged in NOT IN and an inclusive lower and upper bound in
+        BETWEEN. Other criteria are kept as they are.
+        """
+        groups = OrderedDict()
+        for name, comparator, value in criteria:
+            groups.setdefault(name, []).append((comparator, value))
+
+        merged = []
+        for name, items in groups.items():
+            if name not in self.columns or len(items) == 1:
+                merged.extend((name, c, v) for c, v in items)
+                continue
+
+            merges = [('__eq__', 'in_')]
+            if intersect:
+                merges.append(('__neq__', 'notin_'))
+
+            for comparator, merged_comparator in merges:
+                values = []
+                for c, v in items:
+                    if c == comparator and v not in values:
+                        values.append(v)
+
+                if len(values) > 1:
+                    items = [(c, v) for c, v in items if c != comparator]
+                    items.append((merged_comparator, values))
+
+            lower = [v for c, v in items if c == '__gte__']
+            upper = [v for c, v in items if c == '__lte__']
+            if intersect and len(lower) == 1 and len(upper) == 1:
+                items = [(c, v) for c, v in items
+                         if c not in ('__gte__', '__lte__')]
+                items.append(('between', (lower[0], upper[0])))
+
+            merged.extend((name, c, v) for c, v in items)
+
+        return merged
+
+    def get_load_plan(self, cols, overrides=None, streaming=False):
+        """ Return the LoadPlan of plan_eager_loads, computed once by
+        arguments. Plans are shared: do not change them.
+        """
+        key = (tuple(cols), tuple(sorted((overrides or {}).items())),
+               streaming)
+        try:
+            return self.load_plans[key]
+
+        except KeyError:
+            plan = plan_eager_loads(self.cls, cols, overrides, streaming)
+            return self.load_plans.setdefault(key, plan)
+
+    def is_empty(self, name, value):
+        """ Return True if ``value`` of a criterion does not filter.
+
+        Relationships values are mappings of the related columns, or a
+        sequence of them for collections.
+        """
+        if value is colander.null:
+            return True
+
+        if name in self.columns:
+            return False
+
+        return not get_related_filters(value)
+
+
+def get_related_filters(value):
+    items = value if isinstance(value, (list, tuple)) else [value]
+    filters = [{key: v for key, v in item.items() if v is not colander.null}
+               for item in items if isinstance(item, dict)]
+    return [item for item in filters if item]
+
+
+def relationship_criterion(attr, comparator, value):
+    """ Return the criterion comparing relationship ``attr`` to related
+    objects matching the columns values in ``value``.
+    """
+    if attr.property.uselist:
+        exists = attr.any
+
+    else:
+        exists = attr.has
+
+    criterion = and_(*[exists(**item) for item in get_related_filters(value)])
+    if comparator in ('__neq__', 'notcontains'):
+        return ~criterion
+
+    return criterion
+
+
+_search_metadata = {}
+_search_metadata_lock = threading.Lock()
+
+
+def get_search_metadata(cls):
+    """ Return the SearchMetadata of ``cls``, computed once. """
+    try:
+        return _search_metadata[cls]
+
+    except KeyError:
+        with _search_metadata_lock:
+            if cls not in _search_metadata:
+                _search_metadata[cls] = SearchMetadata(cls)
+
+            return _search_metadata[cls]
+
+
+def search_with_window(query, start, limit):
+    """ Return the page of ``query`` and the total count of its rows.
+
+    The total is fetched in the same statement with a window function;
+    when a page past the end is empty the total cannot be read from the
+    rows and None is returned in its place.
+    """
+    names = [desc['name'] for desc in query.column_descriptions]
+    total = func.count().over().label('pyramidion_total')
+    rows = query.add_columns(total)[start:start + limit]
+    if rows and len(names) == 1:
+        return [row[0] for row in rows], rows[0][-1]
+
+    elif rows:
+        # Rows of columns, e.g. projected: drop only the total.
+        Row = namedtuple('Row', names, rename=True)
+        return [Row(*row[:-1]) for row in rows], rows[0][-1]
+
+    elif start == 0:
+        return [], 0
+
+    return [], None
+
+
+# colander types used to load cursor values dumped as ISO strings.
+CURSOR_TYPES = {datetime.datetime: colander.DateTime(default_tzinfo=None),
+                datetime.date: colander.Date(),
+                datetime.time: colander.Time(),
+                Decimal: colander.Decimal()}
+
+
+def dump_cursor_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+
+    elif isinstance(value, Decimal):
+        return str(value)
+
+    return value
+
+
+def load_cursor_value(column, value):
+    try:
+        type_ = CURSOR_TYPES.get(column.type.python_type)
+
+    except NotImplementedError:
+        type_ = None
+
+    if value is None or type_ is None:
+        return value
+
+    return colander.SchemaNode(type_).deserialize(value)
+
+
+def encode_cursor(order_by, direction, values, backward=False):
+    """ Return an opaque token pointing after (or before) ``values``.
+
+    The token carries the sort column and direction too, so following
+    a cursor does not depend on the rest of the query string.
+    """
+    data = [order_by, direction, backward,
+            [dump_cursor_value(v) for v in values]]
+    token = base64.urlsafe_b64encode(json.dumps(data).encode('utf-8'))
+    return token.decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """ Return (order_by, direction, backward, values) from a token.
+    """
+    try:
+        token = str(token)
+        token += '=' * (-len(token) % 4)
+        data = base64.urlsafe_b64decode(token.encode('ascii'))
+        order_by, direction, backward, values = json.loads(data.decode('utf-8'))
+
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError('Invalid cursor: {}'.format(e))
+
+    if direction not in ('asc', 'desc') or not isinstance(values, list):
+        raise ValueError('Invalid cursor: {}'.format(token))
+
+    return order_by, direction, bool(backward), values
+
+
+class CursorValidator(object):
+    """ colander validator of keyset cursor tokens of ``cls``: they must
+    decode to values of its sort attributes.
+    """
+
+    def __init__(self, cls):
+        self.cls = cls
+
+    def __call__(self, node, value):
+        try:
+            load_cursor(self.cls, value)
+
+        except ValueError as e:
+            raise colander.Invalid(node, str(e))
+
+
+def get_keyset_attrs(cls, order_by=None):
+    """ Return the sort attributes: ``order_by`` and PKs as tiebreakers.
+    """
+    inspector = inspect(cls)
+    names = [p.key for p in inspector.column_attrs]
+    if order_by is not None and order_by not in names:
+        raise ValueError('Unknown order by: {}'.format(order_by))
+
+    keys = [order_by] if order_by else []
+    keys.extend([p.key for p in inspector.column_attrs
+                 if p.columns[0] in inspector.primary_key and
+                 p.key != order_by])
+    return [getattr(cls, key) for key in keys]
+
+
+def get_keyset_keys(cls, order_by=None, cursor=None):
+    """ Return the keys of the sort attributes of a keyset page, the ones
+    of ``cursor`` if given: projections must load them to build cursors.
+    """
+    if cursor:
+        order_by = decode_cursor(cursor)[0]
+
+    return [a.key for a in get_keyset_attrs(cls, order_by)]
+
+
+def load_cursor(cls, token):
+    """ Return (order_by, direction, backward, attrs, values) from a
+    cursor token of ``cls``, values loaded as the types of attrs.
+    """
+    order_by, direction, backward, values = decode_cursor(token)
+    attrs = get_keyset_attrs(cls, order_by)
+    if len(values) != len(attrs):
+        raise ValueError('Invalid cursor: {}'.format(token))
+
+    try:
+        values = [load_cursor_value(a.property.columns[0], v)
+                  for a, v in zip(attrs, values)]
+
+    except colander.Invalid as e:
+        raise ValueError('Invalid cursor: {}'.format(e))
+
+    return order_by, direction, backward, attrs, values
+
+
+def keyset_criterion(attrs, values, ascending=True):
+    """ Return the criterion selecting rows after ``values``.
+
+    Written as (a > x) OR (a = x AND b > y) ... instead of using row
+    values, so that it works on every backend. Sort columns must not
+    contain NULLs.
+    """
+    clauses = []
+    for i, attr in enumerate(attrs):
+        equals = [a == v for a, v in zip(attrs[:i], values[:i])]
+        if ascending:
+            seek = attr > values[i]
+
+        else:
+            seek = attr < values[i]
+
+        clauses.append(and_(*(equals + [seek])))
+
+    return or_(*clauses)
+
+
+def search_with_keyset(query, cls, order_by, direction, limit, cursor=None):
+    """ Return a page of ``query`` using keyset (seek) pagination.
+
+    Return a tuple (items, previous, next) where previous and next are
+    cursor tokens or None when there is no such page.
+    """
+    backward = False
+    values = None
+    if cursor:
+        order_by, direction, backward, attrs, values = load_cursor(cls,
+                                                                   cursor)
+
+    else:
+        attrs = get_keyset_attrs(cls, order_by)
+
+    ascending = (direction == 'asc') != backward
+    if values is not None:
+        query = query.filter(keyset_criterion(attrs, values, ascending))
+
+    query = query.order_by(None).order_by(*[a.asc() if ascending else a.desc()
+                                             for a in attrs])
+    # Fetch one more row to know if there is another page.
+    items = query[:limit + 1]
+    more = len(items) > limit
+    items = items[:limit]
+    if backward:
+        items.reverse()
+        has_previous, has_next = more, True
+
+    else:
+        has_previous, has_next = values is not None, more
+
+    previous = next_ = None
+    keys = [a.key for a in attrs]
+    if items and has_previous:
+        previous = encode_cursor(order_by, direction,
+                                 [getattr(items[0], k) for k in keys],
+                                 backward=True)
+
+    if items and has_next:
+        next_ = encode_cursor(order_by, direction,
+                              [getattr(items[-1], k) for k in keys])
+
+    return items, previous, next_
+
+
+LOADERS = {'joined': joinedload,
+           'selectin': selectinload or subqueryload,
+           'subquery': subqueryload,
+           'lazy': lazyload,
+           'noload': noload}
+
+
+class LoadPlan(object):
+    """ Loader options to apply to a search query and why.
+    """
+
+    def __init__(self):
+        self.options = []
+        self.strategies = OrderedDict()
+
+    def report(self):
+        return ', '.join(['{}: {}'.format(path, strategy)
+                          for path, strategy in self.strategies.items()])
+
+
+def plan_eager_loads(cls, cols, overrides=None, streaming=False):
+    """ Return a LoadPlan eager loading relationships walked by ``cols``.
+
+    Every relationship found along a dotted column is loaded with
+    ``overrides[path]`` if given, otherwise many-to-one relationships
+    are joined and collections are loaded with a second SELECT IN query
+    (left lazy when ``streaming``, since yield_per cannot be combined
+    with collection eager loading). Criterions on relationships are
+    compiled to subqueries and do not need relationships to be loaded.
+    """
+    overrides = overrides or {}
+    plan = LoadPlan()
+    for col in cols:
+        mapper = inspect(cls)
+        option = None
+        path = []
+        for name in col.split('.'):
+            if name not in mapper.relationships:
+                break
+
+            prop = mapper.relationships[name]
+            path.append(name)
+            key = '.'.join(path)
+            if key in overrides:
+                strategy = overrides[key]
+
+            elif not prop.uselist:
+                strategy = 'joined'
+
+            elif streaming:
+                strategy = 'lazy'
+
+            else:
+                strategy = 'selectin'
+
+            loader = LOADERS[strategy]
+            attr = getattr(mapper.class_, name)
+            if option is None:
+                option = loader(attr)
+
+            else:
+                option = getattr(option, loader.__name__)(attr)
+
+            plan.strategies.setdefault(key, strategy)
+            mapper = prop.mapper
+
+        if option is not None:
+            plan.options.append(option)
+
+    return plan
+
+
+def get_projection(cls, cols, extra=()):
+    """ Return the column attributes needed to show ``cols``.
+
+    Return a tuple (keys, plain): keys lists PKs, plain columns, the
+    local columns of walked relationships and the ``extra`` column
+    attributes, e.g. sort keys; plain is True when all ``cols`` are
+    column attributes, so rows can replace entities.
+    """
+    inspector = inspect(cls)
+    keys = [p.key for p in inspector.column_attrs
+            if p.columns[0] in inspector.primary_key]
+    plain = True
+    for col in cols:
+        name = col.split('.')[0]
+        if name in inspector.column_attrs and '.' not in col:
+            names = [name]
+
+        elif name in inspector.relationships:
+            prop = inspector.relationships[name]
+            names = [inspector.get_property_by_column(c).key
+                     for c in prop.local_columns
+                     if c in inspector.columns.values()]
+            plain = False
+
+        else:
+            names = []
+            plain = False
+
+        keys.extend([n for n in names if n not in keys])
+
+    keys.extend([n for n in extra if n not in keys])
+    return keys, plain
+
+
+def project(query, cls, cols, mode='load_only', extra=()):
+    """ Restrict ``query`` to the columns needed to show ``cols``, and
+    to the ``extra`` column attributes.
+
+    With mode 'load_only' entities are still returned, with the other
+    columns deferred; with mode 'columns' query returns lightweight
+    named rows instead, if every column in ``cols`` is a plain column.
+    """
+    keys, plain = get_projection(cls, cols, extra)
+    if mode == 'columns' and plain:
+        return query.with_entities(*[getattr(cls, key) for key in keys])
+
+    return query.options(load_only(*keys))
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+# Comparators accepted in query specs, by name.
+QUERY_COMPARATORS = {'__eq__': operator.eq,
+                     '__ne__': operator.ne,
+                     '__lt__': operator.lt,
+                     '__le__': operator.le,
+                     '__gt__': operator.gt,
+                     '__ge__': operator.ge,
+                     'like': _method('like'),
+                     'ilike': _method('ilike'),
+                     'startswith': _method('startswith'),
+                     'endswith': _method('endswith'),
+                     'contains': _method('contains'),
+                     'match': fulltext_match}
+
+if EXPANDING_IN:
+    QUERY_COMPARATORS['in_'] = _method('in_')
+
+# Comparators of query specs taking a non empty list of values, the
+# others take a scalar.
+LIST_COMPARATORS = ('in_',)
+
+
+class QuerySpecCompiler(object):
+    """ Compile query specs into criterions and order by clauses.
+
+    A spec is a dict as sent by Ember clients:
+
+    {"criterions": [{"attr": "name", "comparator": "like", "value": "A%"}],
+     "orderby": [{"attr": "name", "order": "asc"}]}
+
+    Attributes and comparators are checked against a whitelist built
+    from the mapper, raising InvalidQuery before any database work.
+    Clauses are built with bound parameters once per spec shape (specs
+    differing only in values) and kept in a LRU cache.
+    """
+
+    def __init__(self, cls, comparators=None, maxsize=256):
+        inspector = inspect(cls)
+        self.attrs = {p.key: getattr(cls, p.key)
+                      for p in inspector.column_attrs}
+        self.comparators = comparators or QUERY_COMPARATORS
+        self.cache = LRUCache(maxsize=maxsize)
+
+    def normalize(self, spec):
+        """ Return the spec shape, usable as key, and its values.
+        """
+        if not isinstance(spec, dict):
+            raise InvalidQuery('Query must be an object.')
+
+        criterions = []
+        values = []
+        try:
+            for c in spec.get('criterions', []):
+                attr, comparator, value = c['attr'], c['comparator'], c['value']
+                if attr not in self.attrs:
+                    raise InvalidQuery('Unknown attribute: {}'.format(attr))
+
+                if comparator not in self.comparators:
+                    msg = 'Unknown comparator: {}'.format(comparator)
+                    raise InvalidQuery(msg)
+
+                if comparator in LIST_COMPARATORS:
+                    if not isinstance(value, list) or not value:
+                        msg = '{} needs a non empty list: {}'.format(
+                            comparator, attr)
+                        raise InvalidQuery(msg)
+
+                elif isinstance(value, (list, dict)):
+                    msg = '{} needs a scalar value: {}'.format(comparator,
+                                                               attr)
+                    raise InvalidQuery(msg)
+
+                # NULL comparisons are compiled to IS [NOT] NULL.
+                criterions.append((attr, comparator, value is None))
+                if value is not None:
+                    values.append(value)
+
+            orderby = []
+            for c in spec.get('orderby', []):
+                attr, order = c['attr'], c.get('order', 'asc')
+                if attr not in self.attrs:
+                    raise InvalidQuery('Unknown attribute: {}'.format(attr))
+
+                if order not in ('asc', 'desc'):
+                    raise InvalidQuery('Unknown order: {}'.format(order))
+
+                orderby.append((attr, order))
+
+        except (KeyError, TypeError) as e:
+            raise InvalidQuery('Malformed query: {}'.format(e))
+
+        return (tuple(criterions), tuple(orderby)), values
+
+    def build(self, shape):
+        criterions = []
+        i = 0
+        for attr, comparator, null in shape[0]:
+            attr = self.attrs[attr]
+            if null:
+                value = None
+
+            else:
+                name = 'p{}'.format(i)
+                type_ = attr.property.columns[0].type
+                if comparator == 'in_':
+                    value = bindparam(name, type_=type_, expanding=True)
+
+                else:
+                    value = bindparam(name, type_=type_)
+
+                i += 1
+
+            criterions.append(self.comparators[comparator](attr, value))
+
+        order_by = [getattr(self.attrs[attr], order)()
+                    for attr, order in shape[1]]
+        return tuple(criterions), tuple(order_by)
+
+    def compile(self, spec):
+        """ Return (criterions, order_by, params) for ``spec``.
+
+        ``params`` binds the spec values: apply it with Query.params().
+        """
+        shape, values = self.normalize(spec)
+        compiled = self.cache.get(shape)
+        if compiled is None:
+            compiled = self.build(shape)
+            self.cache.set(shape, compiled)
+
+        criterions, order_by = compiled
+        params = {'p{}'.format(i): value for i, value in enumerate(values)}
+        return criterions, order_by, params
+
+
+AGGREGATES = ('sum', 'min', 'max', 'avg')
+
+
+def get_facet_column(cls, name):
+    """ Return the column grouped by facet ``name``: a column or the
+    foreign key of a many-to-one relationship.
+    """
+    mapper = inspect(cls)
+    if name in mapper.column_attrs:
+        return mapper.column_attrs[name].columns[0]
+
+    if name in mapper.relationships:
+        prop = mapper.relationships[name]
+        columns = list(prop.local_columns)
+        if not prop.uselist and len(columns) == 1:
+            return columns[0]
+
+    raise ValueError('Unsupported facet: {}'.format(name))
+
+
+def load_facet_value(column, value):
+    # Values are cast to strings to be unioned.
+    if value is None:
+        return None
+
+    if isinstance(column.type, Boolean):
+        return value.lower() in ('1', 't', 'true')
+
+    if isinstance(column.type, Integer):
+        return int(value)
+
+    return value
+
+
+def compute_facets(query, cls, facets=(), aggregates=None, params=None):
+    """ Return facet counts and aggregates of the rows of ``query``.
+
+    ``facets`` are column or many-to-one relationship names and
+    ``aggregates`` map numeric column names to functions in AGGREGATES.
+    All are computed in a single UNION ALL query reading the rows
+    matching ``query`` from a common table expression, returning:
+
+    ({'gender': [('F', 7), ('M', 10)]}, {'price': {'max': Decimal(...)}})
+
+    Facets of relationships are counted by foreign key value. ``params``
+    are the values of bind parameters in ``query`` criterions.
+    """
+    aggregates = aggregates or {}
+    columns = OrderedDict()
+    for name in facets:
+        columns[name] = get_facet_column(cls, name)
+
+    for name, functions in aggregates.items():
+        if name not in columns:
+            columns[name] = get_facet_column(cls, name)
+
+        if not isinstance(columns[name].type, (Float, Integer, Numeric)):
+            raise ValueError('Not numeric: {}'.format(name))
+
+        for function in functions:
+            if function not in AGGREGATES:
+                raise ValueError('Unknown aggregate: {}'.format(function))
+
+    rows = query.order_by(None)\
+                .with_entities(*[column.label(name)
+                                 for name, column in columns.items()])\
+                .cte('pyramidion_facets')
+    selects = []
+    for name in facets:
+        column = rows.c[name]
+        row = select_facet_row('facet',
+                               name,
+                               cast(column, String),
+                               func.count(),
+                               cast(null(), Numeric))
+        selects.append(row.group_by(column))
+
+    for name, functions in aggregates.items():
+        for function in functions:
+            value = getattr(func, function)(rows.c[name])
+            selects.append(select_facet_row('aggregate',
+                                            name,
+                                            literal(function),
+                                            cast(null(), Integer),
+                                            cast(value, Numeric)))
+
+    facet_counts = OrderedDict((name, []) for name in facets)
+    values = OrderedDict((name, {}) for name in aggregates)
+    if not selects:
+        return facet_counts, values
+
+    result = query.session.execute(union_all(*selects),
+                                   params or {},
+                                   mapper=cls)
+    for kind, name, value, count, total in result:
+        if kind == 'facet':
+            value = load_facet_value(columns[name], value)
+            facet_counts[name].append((value, count))
+
+        else:
+            values[name][value] = total
+
+    for counts in facet_counts.values():
+        counts.sort(key=lambda item: -item[1])
+
+    return facet_counts, values
+
+
+def select_facet_row(kind, name, value, count, total):
+    return select([literal(kind).label('kind'),
+                   literal(name).label('name'),
+                   value.label('value'),
+                   count.label('count'),
+                   total.label('total')])
@@ -0,0 +1,171 @@
+# Copyright (C) 2012 the Pyramidion authors and contributors
+# <see AUTHORS file>
+#
+# This module is part of Pyramidion and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+
+from decimal import Decimal
+from operator import attrgetter
+from sqlalchemy import inspect
+import datetime
+import json
+import logging
+
+__all__ = ['Serializer', 'StreamingJSON']
+
+log = logging.getLogger(__file__)
+
+
+def isoformat(value):
+    return value.isoformat()
+
+
+def get_converter(column):
+    """ Return the callable making column values JSON-ready, if any.
+    """
+    try:
+        type_ = column.type.python_type
+
+    except NotImplementedError:
+        return None
+
+    if issubclass(type_, (datetime.date, datetime.time)):
+        return isoformat
+
+    elif issubclass(type_, Decimal):
+        # As strings: floats would lose precision.
+        return str
+
+    return None
+
+
+class Serializer(object):
+    """ Turn ORM objects or rows into JSON-ready dicts.
+
+    Attribute getters and type converters of ``fields`` are compiled
+    once. Relationships are serialized as dicts (lists of dicts for
+    collections) of the columns of the related objects.
+    """
+
+    def __init__(self, cls, fields=None, nested=True):
+        inspector = inspect(cls)
+        if fields is None:
+            fields = [prop.key for prop in inspector.attrs]
+
+        self.fields = []
+        self.relationships = []
+        for key in fields:
+            if key in inspector.column_attrs:
+                column = inspector.column_attrs[key].columns[0]
+                converter = get_converter(column)
+
+            elif key in inspector.relationships and nested:
+                prop = inspector.relationships[key]
+                serializer = Serializer(prop.mapper.class_,
+                                        [p.key for p in prop.mapper.column_attrs],
+                                        nested=False)
+                converter = serializer.many if prop.uselist else serializer
+                self.relationships.append(key)
+
+            else:
+                continue
+
+            self.fields.append((key, attrgetter(key), converter))
+
+    def __call__(self, obj):
+        data = {}
+        for key, getter, converter in self.fields:
+            value = getter(obj)
+            if converter is not None and value is not None:
+                value = converter(value)
+
+            data[key] = value
+
+        return data
+
+    def many(self, objs):
+        return [self(obj) for obj in objs]
+
+    def iter(self, objs):
+        for obj in objs:
+            yield self(obj)
+
+
+def is_stream(value):
+    return hasattr(value, '__next__') or hasattr(value, 'next')
+
+
+class StreamingJSON(object):
+    """ JSON renderer factory writing iterators one item at a time.
+
+    Iterators found among the values of the rendered dict are written
+    as JSON arrays while they are consumed, in chunks of about
+    ``buffer_size`` characters, through the response ``app_iter``.
+    Other values are rendered as the plain ``json`` renderer does.
+
+    config.add_renderer('json_stream', StreamingJSON())
+    """
+
+    def __init__(self, buffer_size=8192, encoding='utf-8', **kw):
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+        self.kw = kw
+
+    def __call__(self, info):
+
+        def _render(value, system):
+            encoder = json.JSONEncoder(**self.kw)
+            request = system.get('request')
+            if request is not None:
+                response = request.response
+                if response.content_type == response.default_content_type:
+                    response.content_type = 'application/json'
+
+            if not isinstance(value, dict) or \
+               not any(is_stream(v) for v in value.values()):
+                return encoder.encode(value)
+
+            if request is None:
+                # No response to stream to, e.g. render() calls.
+                return ''.join(self.iterchunks(value, encoder))
+
+            request.response.app_iter = self.iterencode(value, encoder)
+            return None
+
+        return _render
+
+    def iterencode(self, value, encoder):
+        buf = []
+        size = 0
+        for chunk in self.iterchunks(value, encoder):
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= self.buffer_size:
+                yield ''.join(buf).encode(self.encoding)
+                buf = []
+                size = 0
+
+        yield ''.join(buf).encode(self.encoding)
+
+    def iterchunks(self, value, encoder):
+        yield '{'
+        for i, (key, item) in enumerate(value.items()):
+            if i:
+                yield ', '
+
+            yield encoder.encode(key)
+            yield ': '
+            if not is_stream(item):
+                yield encoder.encode(item)
+                continue
+
+            yield '['
+            for j, element in enumerate(item):
+                if j:
+                    yield ', '
+
+                yield encoder.encode(element)
+
+            yield ']'
+
+        yield '}'
@@ -0,0 +1,49 @@
+<%page args="paginator"/>
+<div class="pagination pagination-right">
+    <ul>
+        <%
+            first = paginator.first
+            previous = paginator.previous
+            next = paginator.next
+        %>
+        % if previous:
+        <li>
+            <%
+                query = dict(limit=first.limit)
+            %>
+            <a href="${request.current_route_url(_query=query)}">
+        % else:
+        <li class="disabled">
+            <a style="opacity:0.5">
+        %endif
+                <i class="icon-fast-backward"></i>
+            </a>
+        </li>
+        % if previous:
+        <li>
+            <%
+                query = dict(cursor=previous.cursor, limit=previous.limit)
+            %>
+            <a href="${request.current_route_url(_query=query)}">
+        % else:
+        <li class="disabled">
+            <a style="opacity:0.5">
+        %endif
+                <i class="icon-backward"></i>
+            </a>
+        </li>
+        % if next:
+        <li>
+            <%
+                query = dict(cursor=next.cursor, limit=next.limit)
+            %>
+            <a href="${request.current_route_url(_query=query)}">
+        % else:
+        <li class="disabled">
+            <a style="opacity:0.5">
+        %endif
+                <i class="icon-forward"></i>
+            </a>
+        </li>
+    </ul>
+</div>
\ No newline at end of file
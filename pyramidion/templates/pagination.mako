@@ -94,7 +94,7 @@
                 <i class="icon-forward"></i>
             </a>
         </li>
-        % if current != last:
+        % if current != last and paginator.exact:
         <li>
             <a href="${request.current_route_url(_query=query)}">
         % else:
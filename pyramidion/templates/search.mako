@@ -27,5 +27,9 @@ ${form | n}
     % endif
     </tbody>
 </table>
+% if result.paginator.keyset:
+<%include file="pyramidion:templates/keyset_pagination.mako" args="paginator=result.paginator"/>
+% else:
 <%include file="pyramidion:templates/pagination.mako" args="paginator=result.paginator"/>
+% endif
 % endif
\ No newline at end of file
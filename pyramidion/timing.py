@@ -0,0 +1,252 @@
+# Copyright (C) 2012 the Pyramidion authors and contributors
+# <see AUTHORS file>
+#
+# This module is part of Pyramidion and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+
+""" Per-phase timing of views.
+
+Include this module and instrument engines to time requests:
+
+    config.include('pyramidion.timing')
+    instrument_engine(engine)
+
+Views record the duration and the queries of their phases (form build,
+widgets population, validation, queries, dictify, render...) in
+``request.pyramidion_timings``. The tween adds them to the response
+Server-Timing header, then calls ``hooks`` with them: by default
+``default_stats`` keeps histograms by (model, action, phase), returned
+by ``default_stats.dump()``.
+
+Without the tween phases are no-ops.
+"""
+
+from collections import OrderedDict
+from sqlalchemy import event
+import bisect
+import logging
+import threading
+import time
+
+__all__ = ['Timings', 'TimingStats', 'phase', 'timed', 'instrument_engine',
+           'default_stats', 'hooks']
+
+log = logging.getLogger(__file__)
+
+# Timings of the request handled by the current thread.
+_local = threading.local()
+
+
+class Timings(object):
+    """ Durations, in seconds, and queries of the phases of a request.
+
+    Phases nest: the duration of a phase excludes the ones of the
+    phases run within it, so durations add up.
+    """
+
+    def __init__(self):
+        self.durations = OrderedDict()
+        self.phase_queries = {}
+        self.queries = 0
+        self.model = None
+        self.action = None
+        self.stack = []
+        self.start = time.time()
+        self.total = None
+
+    def enter(self, name):
+        # [name, start, duration of nested phases]
+        self.stack.append([name, time.time(), 0.0])
+
+    def exit(self):
+        name, start, nested = self.stack.pop()
+        duration = time.time() - start
+        self.durations[name] = self.durations.get(name, 0.0) + \
+                               duration - nested
+        if self.stack:
+            self.stack[-1][2] += duration
+
+    def count_query(self):
+        self.queries += 1
+        if self.stack:
+            name = self.stack[-1][0]
+            self.phase_queries[name] = self.phase_queries.get(name, 0) + 1
+
+    def finish(self):
+        self.total = time.time() - self.start
+
+    def server_timing(self):
+        """ Return the Server-Timing header value, durations in ms. """
+        metrics = []
+        for name, duration in self.durations.items():
+            metric = '{};dur={:.1f}'.format(name, duration * 1000)
+            queries = self.phase_queries.get(name)
+            if queries:
+                metric += ';desc="queries={}"'.format(queries)
+
+            metrics.append(metric)
+
+        metrics.append('db;desc="queries={}"'.format(self.queries))
+        if self.total is not None:
+            metrics.append('total;dur={:.1f}'.format(self.total * 1000))
+
+        return ', '.join(metrics)
+
+
+class Phase(object):
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.timings.enter(self.name)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.timings.exit()
+
+
+class NullPhase(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+NULL_PHASE = NullPhase()
+
+
+def phase(request, name):
+    """ Return a context manager timing phase ``name`` of ``request``.
+    """
+    timings = getattr(request, 'pyramidion_timings', None)
+    if timings is None:
+        return NULL_PHASE
+
+    return Phase(timings, name)
+
+
+def timed(cls, action):
+    """ Return a view decorator recording the (model, action) of
+    requests, as passed to add_view(decorator=...).
+    """
+
+    def decorator(view):
+
+        def timed_view(context, request):
+            timings = getattr(request, 'pyramidion_timings', None)
+            if timings is not None:
+                timings.model = cls.__name__
+                timings.action = action
+
+            return view(context, request)
+
+        return timed_view
+
+    return decorator
+
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings.count_query()
+
+
+def instrument_engine(engine):
+    """ Count the queries ``engine`` runs in the timings of requests. """
+    if not event.contains(engine, 'before_cursor_execute', count_query):
+        event.listen(engine, 'before_cursor_execute', count_query)
+
+
+class TimingStats(object):
+    """ Histograms of phase durations by (model, action, phase).
+
+    ``buckets`` are the upper bounds, in ms, of all buckets but the last.
+    """
+
+    def __init__(self, buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)):
+        self.buckets = tuple(buckets)
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def record(self, timings):
+        if timings.model is None:
+            # Not a pyramidion view.
+            return
+
+        durations = list(timings.durations.items())
+        if timings.total is not None:
+            durations.append(('total', timings.total))
+
+        with self.lock:
+            for name, duration in durations:
+                key = (timings.model, timings.action, name)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    # Counts by bucket, count, sum of durations in ms.
+                    histogram = [[0] * (len(self.buckets) + 1), 0, 0.0]
+                    self.histograms[key] = histogram
+
+                ms = duration * 1000
+                histogram[0][bisect.bisect_left(self.buckets, ms)] += 1
+                histogram[1] += 1
+                histogram[2] += ms
+
+    def dump(self):
+        """ Return histograms by (model, action, phase) as dicts:
+
+            {'buckets': [(upper bound, count), ...],
+             'count': phases timed,
+             'sum': total duration in ms}
+
+        The upper bound of the last bucket is None.
+        """
+        bounds = self.buckets + (None,)
+        with self.lock:
+            return {key: {'buckets': list(zip(bounds, counts)),
+                          'count': count,
+                          'sum': total}
+                    for key, (counts, count, total)
+                    in self.histograms.items()}
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+
+default_stats = TimingStats()
+
+# Callables called with the Timings of each request.
+hooks = [default_stats.record]
+
+
+def timing_tween_factory(handler, registry):
+
+    def timing_tween(request):
+        timings = Timings()
+        request.pyramidion_timings = timings
+        _local.timings = timings
+        try:
+            response = handler(request)
+
+        finally:
+            _local.timings = None
+            timings.finish()
+
+        response.headers['Server-Timing'] = timings.server_timing()
+        for hook in hooks:
+            try:
+                hook(timings)
+
+            except Exception:
+                log.exception('Timing hook failed.')
+
+        return response
+
+    return timing_tween
+
+
+def includeme(config):
+    config.add_tween('pyramidion.timing.timing_tween_factory')
@@ -4,15 +4,151 @@
 # This module is part of Pyramidion and is released under
 # the MIT License: http://www.opensource.org/licenses/mit-license.php
 
-def setup_routing(config, prefix, classes, adapter):
+from collections import OrderedDict
+from pyramid.httpexceptions import HTTPNotModified
+from sqlalchemy import inspect
+from webob.datetime_utils import UTC
+import hashlib
+import json
+import logging
+import time
 
+log = logging.getLogger(__file__)
+
+# Columns used as Last-Modified when a mapper has no version_id_col.
+UPDATED_AT_KEYS = ('updated_at', 'updated', 'modified_at', 'last_modified')
+
+
+def setup_routing(config, prefix, classes, adapter, warmup=False,
+                  session_factory=None):
+    """ Setup routes and views of an ``adapter`` for every class.
+
+    With ``warmup`` adapters build schemas, forms and serializers now
+    instead of on first requests, and with a ``session_factory``, e.g. a
+    sessionmaker, the statements of default searches in sessions opened
+    and closed for it. Build times by model and step are logged and kept
+    in ``registry.pyramidion_warmup``.
+    """
+    report = OrderedDict()
     for cls in classes:
+        instance = setup_adapter(cls, config, prefix, adapter, warmup,
+                                 session_factory)
         setattr(config.registry,
                 '{}_adapter'.format(cls.__name__.lower()),
-                setup_adapter(cls, config, prefix, adapter))
+                instance)
+        if warmup:
+            report[cls.__name__] = instance.warmup_times
 
+    if warmup:
+        config.registry.pyramidion_warmup = report
 
-def setup_adapter(cls, config, prefix, adapter):
+
+def setup_adapter(cls, config, prefix, adapter, warmup=False,
+                  session_factory=None):
     adapter = adapter(cls=cls)
     adapter.setup_routing(config, prefix)
+    if warmup:
+        times = adapter.warmup_times = adapter.warmup(session_factory)
+        log.info('Warmed up %s in %.1f ms (%s).',
+                 cls.__name__,
+                 sum(times.values()) * 1000,
+                 ', '.join(['{} {:.1f} ms'.format(step, seconds * 1000)
+                            for step, seconds in times.items()]))
+
     return adapter
+
+
+def time_steps(steps):
+    """ Call ``steps``, a sequence of (name, callable), in order and
+    return their durations in seconds by name.
+    """
+    times = OrderedDict()
+    for name, step in steps:
+        start = time.time()
+        step()
+        times[name] = time.time() - start
+
+    return times
+
+
+def get_updated_at_key(mapper):
+    for key in UPDATED_AT_KEYS:
+        if key in mapper.column_attrs:
+            return key
+
+    return None
+
+
+def get_validators(objs, *extra):
+    """ Return (etag, last_modified) of mapped instances ``objs``.
+
+    The ETag hashes PKs and versions (``version_id_col`` or updated-at
+    column values) of objs, plus ``extra`` values as totals. Both are
+    None when an object has no version, e.g. rows of column tuples.
+    """
+    parts = list(extra)
+    last_modified = None
+    for obj in objs:
+        state = inspect(obj, raiseerr=False)
+        if state is None or state.identity is None:
+            return None, None
+
+        mapper = state.mapper
+        key = get_updated_at_key(mapper)
+        updated_at = None if key is None else getattr(obj, key)
+        if mapper.version_id_col is not None:
+            prop = mapper.get_property_by_column(mapper.version_id_col)
+            version = getattr(obj, prop.key)
+
+        else:
+            version = updated_at
+
+        if version is None:
+            return None, None
+
+        if updated_at is not None and hasattr(updated_at, 'tzinfo'):
+            if updated_at.tzinfo is None:
+                # Naive datetimes are assumed UTC.
+                updated_at = updated_at.replace(tzinfo=UTC)
+
+            if last_modified is None or updated_at > last_modified:
+                last_modified = updated_at
+
+        parts.append((mapper.class_.__name__, state.identity, version))
+
+    return hash_payload(repr(parts)), last_modified
+
+
+def hash_payload(payload):
+    """ Return an ETag hashing a JSON serializable ``payload``. """
+    data = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+
+def check_not_modified(request, etag=None, last_modified=None):
+    """ Set validators on ``request.response``.
+
+    Raise HTTPNotModified, carrying the validators, when the request
+    If-None-Match or If-Modified-Since headers show the client copy is
+    fresh, so callers can skip serialization and rendering.
+    """
+    response = request.response
+    if etag is not None:
+        response.etag = etag
+
+    if last_modified is not None:
+        response.last_modified = last_modified
+
+    if 'If-None-Match' in request.headers:
+        # If-Modified-Since is ignored when If-None-Match is sent.
+        fresh = etag is not None and etag in request.if_none_match
+
+    else:
+        since = request.if_modified_since
+        fresh = since is not None and last_modified is not None and \
+                last_modified.replace(microsecond=0) <= since
+
+    if fresh:
+        headers = [(name, value) for name, value in response.headerlist
+                   if name in ('ETag', 'Last-Modified', 'Cache-Control')]
+        raise HTTPNotModified(headers=headers)
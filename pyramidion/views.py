@@ -4,16 +4,40 @@
 # This module is released under the MIT License
 # http://www.opensource.org/licenses/mit-license.php
 
+from .budget import attach_request_budget
+from .cache import (FormCache,
+                    StatementCache,
+                    populate_form)
 from .form import SQLAlchemySimpleSearchForm
-from .widget import (Paginator,
+from .search import (EXPANDING_IN,
+                     SEARCH_COMPARATORS,
+                     compute_facets,
+                     get_keyset_keys,
+                     get_search_metadata,
+                     project,
+                     search_with_keyset,
+                     search_with_window,
+                     supports_window_functions)
+from .timing import (phase,
+                     timed)
+from .utils import (check_not_modified,
+                    get_validators,
+                    hash_payload,
+                    time_steps)
+from .widget import (KeysetPaginator,
+                     Paginator,
                      SearchResult)
 from collections import OrderedDict
 from deform import (Button,
                     ValidationFailure)
 from deformalchemy import SQLAlchemyForm
-from pyramid.httpexceptions import HTTPFound, HTTPForbidden
-from sqlalchemy import inspect
+from pyramid.httpexceptions import HTTPFound, HTTPForbidden, HTTPNotModified
+from sqlalchemy import (and_,
+                        bindparam,
+                        inspect,
+                        or_)
 from sqlalchemy.exc import IntegrityError 
+from sqlalchemy.orm import configure_mappers
 from sqlalchemy.orm.exc import NoResultFound
 import colander
 import logging
@@ -25,14 +49,67 @@ class DeformBase(object):
 
     methods = ['new', 'create', 'edit', 'update',
                'remove', 'delete', 'read', 'search']
-
-    def __init__(self, cls, session=None, db_session_key='db_session'):
+    # How do_search computes the total of rows matching criterions:
+    # 'count' runs a second COUNT query, 'window' reads it from the page
+    # query using count(*) over () and 'skip' only probes for a next page.
+    search_total = 'count'
+    # 'offset' pages with start/limit, 'keyset' seeks from cursor tokens.
+    search_pagination = 'offset'
+    # Rows fetched at a time when rendering results: when set, results
+    # of 'count' searches are streamed instead of loaded upfront.
+    search_chunk_size = None
+    # Loader strategy ('joined', 'selectin', 'subquery', 'lazy', 'noload')
+    # by relationship path, overriding the ones chosen by the planner.
+    search_eager_loads = {}
+    # None loads full entities, 'load_only' defers columns not shown in
+    # the listing and 'columns' selects them as plain rows when possible.
+    search_projection = None
+    # Facet counts of columns or many-to-one relationships, and
+    # aggregates of numeric columns, e.g. {'price': ('min', 'max')},
+    # computed over the search criteria.
+    search_facets = ()
+    search_aggregates = {}
+    # Opt-in query budgets, see pyramidion.budget: statements allowed
+    # per request by route name, or for any route, and repetitions of
+    # a statement allowed, to catch N+1 lazy loads. 'log' warns when
+    # exceeded, 'raise' raises QueryBudgetExceeded.
+    query_budgets = {}
+    query_budget = None
+    query_repeat_limit = None
+    query_budget_mode = 'log'
+
+    def __init__(self, cls, session=None, db_session_key='db_session',
+                 form_cache=None, population_cache=None,
+                 statement_cache=None, object_cache=None,
+                 render_cache=None):
         self.cls = cls
         self.session = session
         self.db_session_key = db_session_key
+        self.form_cache = form_cache or FormCache()
+        self.statement_cache = statement_cache or StatementCache()
+        # Optional, e.g. PopulationCache(), ObjectCache() and
+        # RenderCache(): disabled by default.
+        self.population_cache = population_cache
+        self.object_cache = object_cache
+        self.render_cache = render_cache
         self.routes = {key: '{}_{}'.format(cls.__name__.lower(), key)
                        for key in self.methods}
         self.inspector = inspect(cls)
+        self.primary_keys = [self.inspector.get_property_by_column(c).key
+                             for c in self.inspector.primary_key]
+
+    def get_session(self, request):
+        session = self.session or getattr(request, self.db_session_key)
+        if self.query_budget is not None or self.query_budgets or \
+           self.query_repeat_limit is not None:
+            attach_request_budget(request,
+                                  session,
+                                  self.query_budgets,
+                                  self.query_budget,
+                                  self.query_repeat_limit,
+                                  self.query_budget_mode)
+
+        return session
 
     def new(self, context, request):
         try:
@@ -48,7 +125,9 @@ class DeformBase(object):
         return response
 
     def get_new_response(self, context, request):
-        return {'form': self.get_create_form(context, request).render()}
+        form = self.get_create_form(context, request)
+        with phase(request, 'render'):
+            return {'form': self.render_form(form, 'new')}
 
     def get_new_500_response(self, context, request, exc):
         return {'form': None, 'error': str(exc)}
@@ -96,7 +175,10 @@ class DeformBase(object):
                        for p in self.inspector.column_attrs
                        if p.columns[0] in self.inspector.primary_key}
                 form = self.get_edit_form(context, request, **pks)
-                response = {'form': form.render(params), 'params': params}
+                with phase(request, 'render'):
+                    html = form.render(params)
+
+                response = {'form': html, 'params': params}
 
         return response
 
@@ -116,31 +198,87 @@ class DeformBase(object):
     def get_create_params(self, context, request):
         params = request.POST.items()
         form = self.get_create_form(context, request)
+        with phase(request, 'validate'):
+            appstruct = form.validate(params)
+
         return {name: value
-                for name, value in form.validate(params).items()
+                for name, value in appstruct.items()
                 if not value is colander.null}
 
     def get_create_form(self, context, request):
         route_name = self.routes['create']
-        action = request.route_url(route_name)
+        with phase(request, 'form'):
+            form = self.form_cache.get(self.cls, 'create', 'form-horizontal',
+                                       self.build_create_form)
+
+        form.action = request.route_url(route_name)
+        self.populate_widgets(form, request)
+        return form
+
+    def render_form(self, form, action, pks=None, values=None, obj=None):
+        """ Return ``form`` rendered with ``values``, or the values of
+        ``obj``, through render_cache if any.
+
+        HTML is cached by (model, PK, action, form template, form action
+        URL, widgets population generation): entries of an object are
+        invalidated when the views commit changes to it, so ``obj`` is
+        dictified on cache misses only. Objects changed elsewhere are
+        rendered stale until their entries expire.
+        """
+
+        def render():
+            if obj is not None:
+                return form.render(form.schema.dictify(obj))
+
+            if values is not None:
+                return form.render(values)
+
+            return form.render()
+
+        if self.render_cache is None:
+            return render()
+
+        ident = () if pks is None else self.get_ident(pks)
+        extra = (action,
+                 form.widget.template,
+                 form.action,
+                 self.get_population_generation())
+        return self.render_cache.get(self.cls, ident, extra, render)
+
+    def get_population_generation(self):
+        if self.population_cache is None:
+            return None
+
+        return self.population_cache.generation
+
+    def populate_widgets(self, form, request):
+        session = self.get_session(request)
+        with phase(request, 'populate'):
+            if self.population_cache is None:
+                populate_form(form, session)
+
+            else:
+                self.population_cache.populate_form(form, session)
+
+    def invalidate_population(self):
+        if self.population_cache is not None:
+            self.population_cache.invalidate(self.cls)
+
+    def build_create_form(self, style):
         save = Button(name='submit',
                       title='Save',
                       type='submit',
                       value='submit')
-        style = 'form-horizontal'
-        form = SQLAlchemyForm(self.cls,
-                              action=action,
-                              formid=route_name,
+        return SQLAlchemyForm(self.cls,
+                              formid=self.routes['create'],
                               buttons=(save,),
                               bootstrap_form_style=style)
-        session = self.session or getattr(request, self.db_session_key)
-        form.populate_widgets(session)
-        return form
 
     def do_create(self, context, request, **kwargs):
-        session = self.session or getattr(request, self.db_session_key)
+        session = self.get_session(request)
         try:
-            obj = self.cls.create(session=session, **kwargs)
+            with phase(request, 'query'):
+                obj = self.cls.create(session=session, **kwargs)
 
         except Exception as e:
             log.exception('Error during create')
@@ -148,7 +286,10 @@ class DeformBase(object):
             raise e
 
         else:
-            session.commit()
+            with phase(request, 'commit'):
+                session.commit()
+
+            self.invalidate_population()
 
         return obj
 
@@ -156,6 +297,9 @@ class DeformBase(object):
         try:
             response = self.get_read_response(context, request)
 
+        except HTTPNotModified as e:
+            return e
+
         except Exception as e:
             log.exception('Unknown error.')
             request.response.status = 500
@@ -180,9 +324,21 @@ class DeformBase(object):
             return self.get_read_404_response(context, request, e)
 
         else:
+            etag, last_modified = get_validators([obj])
+            if etag is not None:
+                check_not_modified(request, etag, last_modified)
+
             form = self.get_edit_form(context, request, **params)
-            values = form.schema.dictify(obj)
-            response = {'form': form.render(values), 'values': values, 'obj': obj}
+            with phase(request, 'dictify'):
+                values = form.schema.dictify(obj)
+
+            if etag is None:
+                check_not_modified(request, hash_payload(values))
+
+            with phase(request, 'render'):
+                html = self.render_form(form, 'read', params, values)
+
+            response = {'form': html, 'values': values, 'obj': obj}
 
         return response
 
@@ -199,8 +355,42 @@ class DeformBase(object):
         return request.matchdict
 
     def do_read(self, context, request, **kwargs):
-        session = self.session or getattr(request, self.db_session_key)
-        return self.cls.read(session=session, **kwargs)
+        return self.get_object(request, **kwargs)
+
+    def get_object(self, request, **pks):
+        session = self.get_session(request)
+        ident = self.get_ident(pks)
+        with phase(request, 'query'):
+            if self.object_cache is None:
+                obj = self.statement_cache.get(session, self.cls, ident)
+
+            else:
+                obj = self.object_cache.get(session, self.cls, ident,
+                                            self.statement_cache.get)
+
+        if obj is None:
+            msg = '{} {} not found.'.format(self.cls.__name__, pks)
+            raise NoResultFound(msg)
+
+        return obj
+
+    def get_ident(self, pks):
+        return tuple([pks[key] for key in self.primary_keys])
+
+    def invalidate_object(self, pks):
+        # Called once changes are committed: a failing cache must not
+        # turn them into errors, stale entries expire with their TTL.
+        try:
+            ident = self.get_ident(pks)
+            if self.object_cache is not None:
+                self.object_cache.invalidate(self.cls, ident)
+
+            if self.render_cache is not None:
+                self.render_cache.invalidate(self.cls, ident)
+
+        except Exception:
+            log.exception('Invalidation of %s %s failed.',
+                          self.cls.__name__, pks)
 
     def edit(self, context, request):
         try:
@@ -234,8 +424,10 @@ class DeformBase(object):
 
         else:
             form = self.get_update_form(request, **params)
-            values = form.schema.dictify(obj)
-            response = {'form': form.render(values)}
+            with phase(request, 'render'):
+                html = self.render_form(form, 'edit', params, obj=obj)
+
+            response = {'form': html}
 
         return response
 
@@ -253,24 +445,27 @@ class DeformBase(object):
 
     def get_edit_form(self, context, request, **pks):
         route_name = self.routes['edit']
+        with phase(request, 'form'):
+            form = self.form_cache.get(self.cls, 'edit', 'form-horizontal',
+                                       self.build_edit_form)
+
+        form.action = request.route_url(route_name, **pks)
+        self.populate_widgets(form, request)
+        return form
+
+    def build_edit_form(self, style):
         edit = Button(name='submit',
                       title='Edit',
                       type='submit',
                       value='submit')
-        action = request.route_url(route_name, **pks)
-        form = SQLAlchemyForm(self.cls,
-                              action=action,
-                              formid=route_name,
+        return SQLAlchemyForm(self.cls,
+                              formid=self.routes['edit'],
                               buttons=(edit,),
                               readonly=True,
-                              bootstrap_form_style='form-horizontal')
-        session = self.session or getattr(request, self.db_session_key)
-        form.populate_widgets(session)
-        return form
+                              bootstrap_form_style=style)
 
     def do_edit(self, context, request, **kwargs):
-        session = self.session or getattr(request, self.db_session_key)
-        return self.cls.read(session=session, **kwargs)
+        return self.get_object(request, **kwargs)
 
     def update(self, context, request):
         try:
@@ -309,8 +504,11 @@ class DeformBase(object):
                    for p in self.inspector.column_attrs
                    if p.columns[0] in self.inspector.primary_key}
             form = self.get_update_form(request, **pks)
-            values = form.schema.dictify(obj)
-            response = {'form': form.render(values)}
+            with phase(request, 'dictify'):
+                values = form.schema.dictify(obj)
+
+            with phase(request, 'render'):
+                response = {'form': form.render(values)}
 
         return response
 
@@ -327,32 +525,41 @@ class DeformBase(object):
         pks = request.matchdict
         params = request.POST.items()
         form = self.get_update_form(request, **pks)
+        with phase(request, 'validate'):
+            appstruct = form.validate(params)
+
         values = {key: value
-                  for key, value in form.validate(params).iteritems()
+                  for key, value in appstruct.iteritems()
                   if value != colander.null}
         return pks, values
 
     def get_update_form(self, request, **pks):
         route_name = self.routes['update']
+        with phase(request, 'form'):
+            form = self.form_cache.get(self.cls, 'update', 'form-horizontal',
+                                       self.build_update_form)
+
+        form.action = request.route_url(route_name, **pks)
+        self.populate_widgets(form, request)
+        return form
+
+    def build_update_form(self, style):
         save = Button(name='submit',
                       title='Save',
                       type='submit',
                       value='submit')
-        form = SQLAlchemyForm(self.cls,
-                              action=request.route_url(route_name, **pks),
-                              formid=route_name,
+        return SQLAlchemyForm(self.cls,
+                              formid=self.routes['update'],
                               buttons=(save,),
                               readonly=True,
-                              bootstrap_form_style='form-horizontal')
-        session = self.session or getattr(request, self.db_session_key)
-        form.populate_widgets(session)
-        return form
+                              bootstrap_form_style=style)
 
     def do_update(self, context, request, pks, **values):
-        session = self.session or getattr(request, self.db_session_key)
+        session = self.get_session(request)
         try:
-            obj = self.cls.update(session, pks, **values)
-            session.flush()
+            with phase(request, 'query'):
+                obj = self.cls.update(session, pks, **values)
+                session.flush()
 
         except Exception as e:
             log.exception('Error during update')
@@ -360,7 +567,11 @@ class DeformBase(object):
             raise e
 
         else:
-            session.commit()
+            with phase(request, 'commit'):
+                session.commit()
+
+            self.invalidate_population()
+            self.invalidate_object(pks)
 
         return obj
 
@@ -393,8 +604,10 @@ class DeformBase(object):
 
         else:
             form = self.get_delete_form(request, **params)
-            values = form.schema.dictify(obj)
-            response = {'form': form.render(values)}
+            with phase(request, 'render'):
+                html = self.render_form(form, 'remove', params, obj=obj)
+
+            response = {'form': html}
 
         return response
 
@@ -411,8 +624,7 @@ class DeformBase(object):
         return request.matchdict
 
     def do_remove(self, context, request, **kwargs):
-        session = self.session or getattr(request, self.db_session_key)
-        return self.cls.read(session=session, **kwargs)
+        return self.get_object(request, **kwargs)
 
     def delete(self, context, request):
         try:
@@ -460,24 +672,30 @@ class DeformBase(object):
 
     def get_delete_form(self, request, **pks):
         route_name = self.routes['delete']
+        with phase(request, 'form'):
+            form = self.form_cache.get(self.cls, 'delete', 'form-horizontal',
+                                       self.build_delete_form)
+
+        form.action = request.route_url(route_name, **pks)
+        self.populate_widgets(form, request)
+        return form
+
+    def build_delete_form(self, style):
         btn = Button(name='submit',
                      title='Delete',
                      type='submit',
                      value='submit')
-        form = SQLAlchemyForm(self.cls,
-                              action=request.route_url(route_name, **pks),
-                              formid=route_name,
+        return SQLAlchemyForm(self.cls,
+                              formid=self.routes['delete'],
                               buttons=(btn,),
                               readonly=True,
-                              bootstrap_form_style='form-horizontal')
-        session = self.session or getattr(request, self.db_session_key)
-        form.populate_widgets(session)
-        return form
+                              bootstrap_form_style=style)
 
     def do_delete(self, context, request, **pks):
-        session = self.session or getattr(request, self.db_session_key)
+        session = self.get_session(request)
         try:
-            self.cls.delete(session, **pks)
+            with phase(request, 'query'):
+                self.cls.delete(session, **pks)
 
         except Exception as e:
             log.exception('Error during delete')
@@ -485,14 +703,20 @@ class DeformBase(object):
             raise e
 
         else:
-            session.commit()
+            with phase(request, 'commit'):
+                session.commit()
+
+            self.invalidate_population()
+            self.invalidate_object(pks)
 
         return None
 
     def search(self, context, request):
-        response = self.get_search_response(context, request)
         try:
-            pass
+            response = self.get_search_response(context, request)
+
+        except HTTPNotModified as e:
+            return e
 
         except Exception as e:
             log.exception('Unknown error.')
@@ -508,19 +732,52 @@ class DeformBase(object):
             values = self.validate_search_params(request, params)
             result = self.do_search(context, request, **values)
 
-        except ValidationFailure as e:
+        except (ValidationFailure, colander.Invalid) as e:
             log.exception('Bad request.')
             request.response.status = 400
             response = self.get_search_400_response(context, request, e)
 
         else:
-            form = self.get_search_form(request)
-            response = {'form': form.render(values),
-                        'result': result}
+            self.check_search_validators(request, result)
+            if self.render_search_form(request):
+                form = self.get_search_form(request)
+                with phase(request, 'render'):
+                    html = form.render(values)
+
+            else:
+                html = None
+
+            response = {'form': html, 'result': result}
 
         return response
 
+    def render_search_form(self, request):
+        """ Return True if the search response includes the form HTML.
+
+        XHR callers only get results: the form is neither built nor
+        populated.
+        """
+        return not request.is_xhr
+
+    def check_search_validators(self, request, result):
+        if not isinstance(result.results, list):
+            # Streamed results can be iterated only once.
+            return
+
+        paginator = result.paginator
+        extra = [getattr(paginator, 'total', None),
+                 getattr(paginator, 'next', None)]
+        etag, last_modified = get_validators(result.results, *extra)
+        if etag is None:
+            rows = [list(row) for row in result.rows()]
+            etag = hash_payload([rows] + extra)
+
+        check_not_modified(request, etag, last_modified)
+
     def get_search_400_response(self, context, request, exc):
+        if isinstance(exc, colander.Invalid):
+            return {'form': None, 'error': str(exc)}
+
         return {'form': exc.render(), 'error': str(exc)}
 
     def get_search_500_response(self, context, request, exc):
@@ -533,68 +790,324 @@ class DeformBase(object):
         if not params:
             return {}
 
+        # Validate with the widgets of an unpopulated form: they make the
+        # cstruct of params, e.g. date/time mappings, but their values
+        # (DB queries) are populated only to render errors.
+        form = self.form_cache.get(self.cls, 'search', 'form-inline',
+                                   self.build_search_form)
+        try:
+            with phase(request, 'validate'):
+                appstruct = form.validate(params)
+
+        except ValidationFailure as e:
+            error = e.error
+            cstruct = e.cstruct
+
+        except colander.Invalid as e:
+            # Params not shaped as the schema, e.g. a string for a mapping.
+            error = e
+            cstruct = colander.null
+
+        else:
+            return {name: value
+                    for name, value in appstruct.items()
+                    if not value is colander.null}
+
+        if not self.render_search_form(request):
+            raise error
+
         form = self.get_search_form(request)
-        return {name: value
-                for name, value in form.validate(params).items()
-                if not value is colander.null}
+        form.widget.handle_error(form, error)
+        raise ValidationFailure(form, cstruct, error)
 
     def get_search_form(self, request):
+        # Built at most once per request, e.g. to render errors.
+        attr = 'pyramidion_{}_form'.format(self.routes['search'])
+        form = getattr(request, attr, None)
+        if form is not None:
+            return form
+
         route_name = self.routes['search']
-        action = request.route_url(route_name)
+        with phase(request, 'form'):
+            form = self.form_cache.get(self.cls, 'search', 'form-inline',
+                                       self.build_search_form)
+
+        form.action = request.route_url(route_name)
+        self.populate_widgets(form, request)
+        setattr(request, attr, form)
+        return form
+
+    def build_search_form(self, style):
         btn = Button(name='submit',
                      title='Search',
                      type='submit',
                      value='submit')
-        form = SQLAlchemySimpleSearchForm(self.cls,
-                                          action=action,
+        return SQLAlchemySimpleSearchForm(self.cls,
                                           buttons=(btn,),
-                                          formid=route_name,
-                                          bootstrap_form_style='form-inline')
-        session = self.session or getattr(request, self.db_session_key)
-        form.populate_widgets(session)
-        return form
+                                          formid=self.routes['search'],
+                                          bootstrap_form_style=style)
 
     def do_search(self, context, request, **kwargs):
+        session = self.get_session(request)
+        return self.do_session_search(request, session, **kwargs)
+
+    def do_session_search(self, request, session, **kwargs):
+        """ Search as do_search, in ``session``: without kwargs, as a
+        search without params.
+        """
         start = kwargs.pop('start', 0)
         limit = kwargs.pop('limit', 25)
         order_by = kwargs.pop('order_by', None)
         direction = kwargs.pop('direction', 'asc')
         intersect = kwargs.pop('intersect', True)
-
+        cursor = kwargs.pop('cursor', None)
+
+        metadata = self.search_metadata
+        criteria = []
+        for name in metadata.attrs:
+            # A mapping, or a sequence of mappings as built by
+            # MultiCriterionSearchSchemaNode.
+            attr_criteria = list(kwargs.pop('{}_criterions'.format(name), []))
+            attr_criterion = kwargs.pop('{}_criterion'.format(name), None)
+            if attr_criterion:
+                attr_criteria.insert(0, attr_criterion)
+
+            # Relationships value node is named 'value'.
+            key = name if name in metadata.columns else 'value'
+            for attr_criterion in attr_criteria:
+                value = attr_criterion[key]
+                if metadata.is_empty(name, value):
+                    continue
+
+                criteria.append((name, attr_criterion['comparator'], value))
+
+        criteria = metadata.merge(criteria, intersect)
+
+        with phase(request, 'query'):
+            result = self.do_criteria_search(request, session, criteria,
+                                             order_by, direction, intersect,
+                                             start, limit, cursor)
+
+        if self.search_facets or self.search_aggregates:
+            query = self.cls.search(session,
+                                    *self.get_criterions(criteria),
+                                    intersect=intersect,
+                                    raw_query=True)
+            with phase(request, 'facets'):
+                facets, aggregates = compute_facets(query,
+                                                    self.cls,
+                                                    self.search_facets,
+                                                    self.search_aggregates)
+
+            result.facets = facets
+            result.aggregates = aggregates
+
+        return result
+
+    def get_criterions(self, criteria):
+        metadata = self.search_metadata
+        return [metadata.criterion(name, comparator, value)
+                for name, comparator, value in criteria]
+
+    def do_criteria_search(self, request, session, criteria, order_by,
+                           direction, intersect, start, limit, cursor):
         if order_by:
-            order_by = [getattr(getattr(self.cls, order_by),
-                                direction)()]
+            order_clauses = [getattr(getattr(self.cls, order_by),
+                                     direction)()]
 
-        criterions = []
-        for prop in self.inspector.attrs:
-            name = prop.key
-            attr_criterion = kwargs.pop('{}_criterion'.format(name), None)
-            if not attr_criterion:
-                continue
+        else:
+            order_clauses = None
 
-            value = attr_criterion[name]
-            if value == colander.null:
-                continue
+        cols = self.get_search_columns()
+        plan = self.get_search_load_plan(cols)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s search load plan: %s',
+                      self.cls.__name__, plan.report())
+        if self.can_bake_search(criteria, cursor):
+            return self.do_baked_search(request, session, criteria, order_by,
+                                        direction, intersect, start, limit,
+                                        cols, plan)
+
+        query = self.cls.search(session,
+                                *self.get_criterions(criteria),
+                                order_by=order_clauses,
+                                intersect=intersect,
+                                raw_query=True)
+        count_query = query.order_by(None)
+        query = query.options(*plan.options)
+        keyset = cursor or self.search_pagination == 'keyset'
+        if self.search_projection:
+            # Cursors are built from the sort keys: always load them.
+            extra = get_keyset_keys(self.cls, order_by, cursor) \
+                if keyset else ()
+            query = project(query, self.cls, cols, self.search_projection,
+                            extra)
+
+        if keyset:
+            items, previous, next_ = search_with_keyset(query,
+                                                        self.cls,
+                                                        order_by,
+                                                        direction,
+                                                        limit,
+                                                        cursor)
+            paginator = KeysetPaginator(limit=limit,
+                                        previous=previous,
+                                        next=next_)
+            result = SearchResult(results=items,
+                                  cols=cols,
+                                  paginator=paginator)
+            result.load_plan = plan
+            return result
+
+        mode = self.search_total
+        if mode == 'window':
+            dialect = session.get_bind(self.cls).dialect
+            if not supports_window_functions(dialect):
+                mode = 'count'
+
+        has_next = None
+        if mode == 'window':
+            items, total = search_with_window(query, start, limit)
+            if total is None:
+                with phase(request, 'count'):
+                    total = count_query.count()
+
+        elif mode == 'skip':
+            # Fetch one more row to know if a next page exists.
+            items = query[start:start + limit + 1]
+            has_next = len(items) > limit
+            items = items[:limit]
+            total = None
+
+        elif self.search_chunk_size:
+            items = query.slice(start, start + limit)
+            with phase(request, 'count'):
+                total = count_query.count()
 
-            comparator = attr_criterion['comparator']
-            criterion = getattr(getattr(self.cls, name), comparator)(value)
-            criterions.append(criterion)
+        else:
+            items = query[start:start + limit]
+            with phase(request, 'count'):
+                total = count_query.count()
+
+        paginator = Paginator(total=total,
+                              start=start,
+                              limit=limit,
+                              has_next=has_next)
+        result = SearchResult(results=items,
+                              cols=cols,
+                              paginator=paginator,
+                              chunk_size=self.search_chunk_size)
+        result.load_plan = plan
+        return result
+
+    def can_bake_search(self, criteria, cursor):
+        """ Return True if do_search can use a baked query.
+
+        Baked queries are used for offset pagination with 'count' or
+        'skip' totals, when every criterion compares a column.
+        """
+        return not cursor and \
+               self.search_pagination == 'offset' and \
+               self.search_total in ('count', 'skip') and \
+               not self.search_chunk_size and \
+               all(name in self.search_metadata.columns and
+                   comparator in SEARCH_COMPARATORS and
+                   (EXPANDING_IN or comparator not in ('in_', 'notin_'))
+                   for name, comparator, value in criteria)
+
+    def do_baked_search(self, request, session, criteria, order_by,
+                        direction, intersect, start, limit, cols, plan):
+        cls = self.cls
+        metadata = self.search_metadata
+        shape = tuple([(name, comparator)
+                       for name, comparator, value in criteria])
+        params = {}
+        for i, (name, comparator, value) in enumerate(criteria):
+            key = 'pyramidion_{}'.format(i)
+            if comparator == 'between':
+                params[key + '_0'], params[key + '_1'] = value
 
-        session = self.session or getattr(request, self.db_session_key)
-        items = self.cls.search(session,
-                                *criterions,
-                                order_by=order_by,
-                                start=start,
-                                limit=limit,
-                                intersect=intersect)
-        cols = self.get_search_columns()
-        total = self.cls.search(session,
-                                *criterions,
-                                raw_query=True).count()
-        paginator = Paginator(total=total, start=start, limit=limit)
-        return SearchResult(results=items,
-                            cols=cols,
-                            paginator=paginator)
+            else:
+                params[key] = value
+
+        skip = self.search_total == 'skip'
+        options = (plan.report(), self.search_projection, tuple(cols))
+        key = (cls, shape, intersect, order_by, direction, skip, options)
+        bq = self.statement_cache.query(key,
+                                        lambda session: session.query(cls),
+                                        cls)
+
+        def filter_(query):
+            clauses = []
+            for i, (name, comparator) in enumerate(shape):
+                attr = metadata.attrs[name]
+                type_ = attr.property.columns[0].type
+                key = 'pyramidion_{}'.format(i)
+                if comparator == 'between':
+                    value = (bindparam(key + '_0', type_=type_),
+                             bindparam(key + '_1', type_=type_))
+
+                elif comparator in ('in_', 'notin_'):
+                    value = bindparam(key, type_=type_, expanding=True)
+
+                else:
+                    value = bindparam(key, type_=type_)
+
+                clauses.append(SEARCH_COMPARATORS[comparator](attr, value))
+
+            if intersect:
+                return query.filter(and_(*clauses))
+
+            return query.filter(or_(*clauses))
+
+        if shape:
+            bq.add_criteria(filter_, shape, intersect)
+
+        def page(query):
+            if order_by:
+                query = query.order_by(getattr(getattr(cls, order_by),
+                                               direction)())
+
+            query = query.options(*plan.options)
+            if self.search_projection:
+                query = project(query, cls, cols, self.search_projection)
+
+            return query.offset(bindparam('pyramidion_start'))\
+                        .limit(bindparam('pyramidion_limit'))
+
+        page_bq = bq.with_criteria(page, order_by, direction, options)
+        has_next = None
+        if skip:
+            # Fetch one more row to know if a next page exists.
+            items = page_bq(session).params(pyramidion_start=start,
+                                            pyramidion_limit=limit + 1,
+                                            **params).all()
+            has_next = len(items) > limit
+            items = items[:limit]
+            total = None
+
+        else:
+            items = page_bq(session).params(pyramidion_start=start,
+                                            pyramidion_limit=limit,
+                                            **params).all()
+            with phase(request, 'count'):
+                total = bq(session).params(**params).count()
+
+        paginator = Paginator(total=total,
+                              start=start,
+                              limit=limit,
+                              has_next=has_next)
+        result = SearchResult(results=items,
+                              cols=cols,
+                              paginator=paginator)
+        result.load_plan = plan
+        return result
+
+    def get_search_load_plan(self, cols):
+        return self.search_metadata.get_load_plan(
+            cols,
+            overrides=self.search_eager_loads,
+            streaming=bool(self.search_chunk_size))
 
     def get_search_columns(self):
         col = OrderedDict()
@@ -603,7 +1116,45 @@ class DeformBase(object):
 
         return col
 
+    @property
+    def search_metadata(self):
+        return get_search_metadata(self.cls)
+
+    def warmup(self, session_factory=None):
+        """ Build now what first requests would: mappers, search
+        metadata, form prototypes, the search load plan and, with a
+        ``session_factory``, the statements of the default search.
+        Return build times by step.
+        """
+        steps = [('mappers', configure_mappers),
+                 ('metadata', lambda: get_search_metadata(self.cls)),
+                 ('forms', self.warmup_forms),
+                 ('load_plan', lambda: self.get_search_load_plan(
+                     self.get_search_columns()))]
+        if session_factory is not None:
+            steps.append(('queries',
+                          lambda: self.warmup_queries(session_factory)))
+
+        return time_steps(steps)
+
+    def warmup_forms(self):
+        for action in ('create', 'edit', 'update', 'delete', 'search'):
+            style = 'form-inline' if action == 'search' else 'form-horizontal'
+            self.form_cache.get(self.cls, action, style,
+                                getattr(self, 'build_{}_form'.format(action)))
+
+    def warmup_queries(self, session_factory):
+        # A search without params, in a session of its own.
+        session = session_factory()
+        try:
+            self.do_session_search(None, session)
+
+        finally:
+            session.close()
+
     def setup_routing(self, config, prefix=''):
+        # Computed now rather than on the first search.
+        get_search_metadata(self.cls)
         for action in self.routes:
             getattr(self, 'setup_{}_routing'.format(action))(config, prefix)
 
@@ -617,7 +1168,8 @@ class DeformBase(object):
         config.add_view(getattr(self, action),
                         route_name=route_name,
                         renderer=tpl,
-                        permission=action)
+                        permission=action,
+                        decorator=timed(self.cls, action))
 
     def setup_default_item_routing(self, action, config, prefix=''):
         resource = self.cls.__name__.lower()
@@ -5,35 +5,119 @@
 # the MIT License: http://www.opensource.org/licenses/mit-license.php
 
 from collections import namedtuple
+from operator import attrgetter
 import math
 
 
-class SearchResult(object):
+def compile_accessor(col):
+    """ Return a callable reading the dotted path ``col`` from an object.
+
+    Missing attributes and None found along the path give None.
+    """
+    getter = attrgetter(col)
+
+    def accessor(obj):
+        try:
+            return getter(obj)
+
+        except AttributeError:
+            return None
+
+    return accessor
 
-    def __init__(self, results, cols=None, paginator=None):
-        self.results = results or []
+
+class SearchResult(object):
+    """ Rows of a search and the paginator to browse them.
+
+    ``results`` can be a list or a lazy iterable such as a Query: in this
+    case it is consumed once, ``chunk_size`` rows at a time when given,
+    while rows are rendered. ``facets`` and ``aggregates`` are computed
+    over all the rows matching the search, see search.compute_facets.
+    """
+
+    def __init__(self, results, cols=None, paginator=None, chunk_size=None,
+                 tuples=False, facets=None, aggregates=None):
+        self.results = [] if results is None else results
+        self.facets = facets or {}
+        self.aggregates = aggregates or {}
         self.cols = cols or {}
-        self.paginator = paginator or Paginator(len(self.results), 0, 25)
+        self.chunk_size = chunk_size
+        self.tuples = tuples
+        # Compile cols once: a single attrgetter reads the whole row and
+        # per column accessors are used when a path contains None.
+        names = list(self.cols)
+        self.accessors = [compile_accessor(col) for col in names]
+        if len(names) > 1:
+            self.getter = attrgetter(*names)
+
+        elif names:
+            getter = attrgetter(names[0])
+            self.getter = lambda obj: (getter(obj),)
+
+        else:
+            self.getter = lambda obj: ()
+
+        if paginator is None and hasattr(self.results, '__len__'):
+            paginator = Paginator(len(self.results), 0, 25)
+
+        elif paginator is None:
+            paginator = Paginator(None, 0, 25)
+
+        self.paginator = paginator
+
+    def iter_results(self):
+        results = self.results
+        if self.chunk_size and hasattr(results, 'yield_per'):
+            results = results.yield_per(self.chunk_size)\
+                             .execution_options(stream_results=True)
+
+        return iter(results)
 
     def rows(self):
-        for obj in self.results:
-            yield self.row(obj)
+        row = self.row_tuple if self.tuples else self.row
+        for obj in self.iter_results():
+            yield row(obj)
+
+    def stream(self, render, encoding='utf-8'):
+        """ Yield ``render(row)`` encoded for every row.
+
+        Rows are rendered as they are fetched, so the result can be used
+        as a WSGI ``app_iter`` without building the whole body first.
+        """
+        for row in self.rows():
+            chunk = render(row)
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode(encoding)
+
+            yield chunk
 
     def row(self, obj):
-        for col in self.cols:
-            item = obj
-            for name in col.split('.'):
-                item = getattr(item, name, None)
+        return iter(self.row_tuple(obj))
+
+    def row_tuple(self, obj):
+        try:
+            return self.getter(obj)
 
-            yield item
+        except AttributeError:
+            return tuple([accessor(obj) for accessor in self.accessors])
 
 
 class Paginator(object):
 
-    def __init__(self, total, start, limit, factory=None):
-        self.total = int(total)
+    keyset = False
+
+    def __init__(self, total, start, limit, factory=None, has_next=None):
         self.start = int(start)
         self.limit = int(limit)
+        # When total is unknown pages end at the next one, if any.
+        self.exact = total is not None
+        if not self.exact and has_next:
+            total = self.start + self.limit + 1
+
+        elif not self.exact:
+            total = self.start + 1
+
+        self.total = int(total)
         self.pages = int(math.ceil(float(self.total) / self.limit))
         if factory is None:
             factory = namedtuple('Page', ['number', 'start', 'limit'])
@@ -114,3 +198,33 @@ class Paginator(object):
         return self.Page(number=self._compute_page(start),
                          start=start,
                          limit=self.limit)
+
+
+class KeysetPaginator(object):
+
+    keyset = True
+
+    def __init__(self, limit, previous=None, next=None, factory=None):
+        self.limit = int(limit)
+        self.previous_cursor = previous
+        self.next_cursor = next
+        if factory is None:
+            factory = namedtuple('Page', ['cursor', 'limit'])
+
+        self.Page = factory
+
+    @property
+    def first(self):
+        return self.Page(cursor=None, limit=self.limit)
+
+    @property
+    def previous(self):
+        if self.previous_cursor is None:
+            return None
+        return self.Page(cursor=self.previous_cursor, limit=self.limit)
+
+    @property
+    def next(self):
+        if self.next_cursor is None:
+            return None
+        return self.Page(cursor=self.next_cursor, limit=self.limit)
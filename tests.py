@@ -5,15 +5,66 @@
 # This module is part of Pyramidal and is released under
 # the MIT License: http://www.opensource.org/licenses/mit-license.php
 
+from collections import OrderedDict
+from datetime import (date,
+                      datetime)
+from decimal import Decimal
 from pyramid import testing
+from pyramid.exceptions import ConfigurationError
+from pyramid.httpexceptions import HTTPNotModified
+from pyramid.request import Request
 from pyramidal import Base as Handler
+from pyramidion.budget import (QueryBudget,
+                               QueryBudgetExceeded,
+                               attach_budget,
+                               attach_request_budget,
+                               get_budget)
+from pyramidion.cache import (FormCache,
+                              LRUCache,
+                              ObjectCache,
+                              PopulationCache,
+                              RenderCache,
+                              StatementCache)
+from pyramidion.ember import EmberDataBase
+from pyramidion.fulltext import (declare_fulltext_index,
+                                 fulltext_match)
+from pyramidion.search import (CursorValidator,
+                               InvalidQuery,
+                               QuerySpecCompiler,
+                               compute_facets,
+                               encode_cursor,
+                               get_search_metadata,
+                               supports_window_functions)
+from pyramidion.serializer import StreamingJSON
+from pyramidion.timing import (Timings,
+                               TimingStats,
+                               instrument_engine,
+                               timing_tween_factory)
+from pyramidion.utils import (check_not_modified,
+                              setup_routing)
+from pyramidion.views import DeformBase
+from webob.datetime_utils import UTC
+import colander
+import crudalchemy
+import deform
+import deform_bootstrap
+import json
 import logging
+import os
 import sqlalchemy
+import sqlalchemy.dialects.mysql
+import sqlalchemy.dialects.postgresql
 import sqlalchemy.ext.declarative
 import sqlalchemy.orm
 import sqlalchemy.schema
 import unittest
 
+try:
+    from urllib import urlencode
+
+except ImportError:
+    from urllib.parse import urlencode
+
 
 log = logging.getLogger(__name__)
 Base = sqlalchemy.ext.declarative.declarative_base()
@@ -170,3 +221,1034 @@ class TestsBase(unittest.TestCase):
         response = self.account.delete(request.context, request)
         self.assertEqual(response, {})
         self.assertEqual(request.response.status, '404 Not Found')
+
+
+# Models of pyramidion adapters tests: adapters use the CRUD class
+# methods of crudalchemy.
+CRUDBase = sqlalchemy.ext.declarative.declarative_base(
+    cls=crudalchemy.CRUDBase)
+
+
+class Author(CRUDBase):
+    __tablename__ = 'authors'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    name = sqlalchemy.Column(sqlalchemy.Unicode(128), nullable=False)
+
+
+class Book(CRUDBase):
+    __tablename__ = 'books'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    title = sqlalchemy.Column(sqlalchemy.Unicode(128), nullable=False)
+    pages = sqlalchemy.Column(sqlalchemy.Integer)
+    price = sqlalchemy.Column(sqlalchemy.Numeric(10, 2))
+    published = sqlalchemy.Column(sqlalchemy.Date)
+    author_id = sqlalchemy.Column(sqlalchemy.Integer,
+                                  sqlalchemy.ForeignKey('authors.id'))
+    author = sqlalchemy.orm.relationship(lambda: Author, backref='books')
+
+
+class AdapterTestsBase(unittest.TestCase):
+    """ 10 books by 3 authors: Book i has i + 1 as id, 100 + i pages
+    and author i % 3 + 1.
+    """
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.engine = sqlalchemy.create_engine('sqlite://', echo=False)
+        CRUDBase.metadata.create_all(self.engine)
+        self.Session = sqlalchemy.orm.sessionmaker(bind=self.engine)
+        self.session = self.Session()
+        authors = [Author(id=i + 1, name=u'Author {}'.format(i))
+                   for i in range(3)]
+        self.session.add_all([Book(id=i + 1,
+                                   title=u'Book {}'.format(i),
+                                   pages=100 + i,
+                                   price=Decimal('9.99') + i,
+                                   published=date(2012, 1, 1 + i),
+                                   author=authors[i % 3])
+                              for i in range(10)])
+        self.session.commit()
+
+    def tearDown(self):
+        testing.tearDown()
+        self.session.close()
+
+    def request(self, params=(), matchdict=None, **kw):
+        request = Request.blank('/?' + urlencode(list(params)), **kw)
+        request.registry = self.config.registry
+        request.matchdict = matchdict or {}
+        return request
+
+
+class DeformTestsBase(AdapterTestsBase):
+
+    adapter_class = DeformBase
+
+    def setUp(self):
+        AdapterTestsBase.setUp(self)
+        dirs = [os.path.join(os.path.dirname(module.__file__), 'templates')
+                for module in (deform_bootstrap, deform)]
+        deform.Form.set_zpt_renderer(dirs)
+        self.adapter = self.adapter_class(Book, session=self.session)
+        for action, route_name in self.adapter.routes.items():
+            path = '/book/{}'.format(action)
+            if action not in ('new', 'create', 'search'):
+                path += '/{id}'
+
+            self.config.add_route(route_name, path)
+
+
+class TestsFormCache(DeformTestsBase):
+
+    def test_clones(self):
+        cache = FormCache()
+        built = []
+
+        def build(style):
+            built.append(style)
+            return self.adapter.build_edit_form(style)
+
+        first = cache.get(Book, 'edit', 'form-horizontal', build)
+        second = cache.get(Book, 'edit', 'form-horizontal', build)
+        self.assertEqual(built, ['form-horizontal'])
+        self.assertIsNot(first, second)
+        self.assertIsNot(first['title'], second['title'])
+        self.assertIs(first['title'].parent, first)
+        first.action = '/first'
+        self.assertNotEqual(second.action, '/first')
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_render(self):
+        request = self.request(matchdict={'id': '1'})
+        first = self.adapter.read(None, request)['form']
+        request = self.request(matchdict={'id': '2'})
+        second = self.adapter.read(None, request)['form']
+        self.assertIn('Book 0', first)
+        self.assertIn('Book 1', second)
+        self.assertNotIn('Book 0', second)
+
+
+class TestsSearchTotals(DeformTestsBase):
+
+    def search(self, mode, start):
+        self.adapter.search_total = mode
+        return self.adapter.do_search(None, self.request(), start=start,
+                                      limit=4, order_by='id')
+
+    def test_count(self):
+        result = self.search('count', 8)
+        self.assertEqual([book.id for book in result.results], [9, 10])
+        self.assertEqual(result.paginator.total, 10)
+
+    def test_skip(self):
+        result = self.search('skip', 4)
+        self.assertEqual([book.id for book in result.results], [5, 6, 7, 8])
+        self.assertFalse(result.paginator.exact)
+        # Pages end at the next one: the last page is unknown.
+        self.assertEqual(result.paginator.last.start, 8)
+        result = self.search('skip', 8)
+        self.assertEqual([book.id for book in result.results], [9, 10])
+        self.assertEqual(result.paginator.last.start, 8)
+
+
+class BrokenBackend(LRUCache):
+
+    def delete(self, key):
+        raise IOError('Cache server down.')
+
+
+class TestsObjectCache(DeformTestsBase):
+
+    def setUp(self):
+        DeformTestsBase.setUp(self)
+        self.adapter.object_cache = ObjectCache()
+        self.statements = []
+        sqlalchemy.event.listen(self.engine, 'before_cursor_execute',
+                                self.count)
+
+    def tearDown(self):
+        sqlalchemy.event.remove(self.engine, 'before_cursor_execute',
+                                self.count)
+        DeformTestsBase.tearDown(self)
+
+    def count(self, conn, cursor, statement, *args):
+        if statement.startswith('SELECT'):
+            self.statements.append(statement)
+
+    def read(self, id):
+        # A session by request.
+        self.adapter.session = self.Session()
+        return self.adapter.get_object(self.request(), id=id)
+
+    def test_read_through(self):
+        self.assertEqual(self.read(1).title, u'Book 0')
+        self.assertEqual(len(self.statements), 1)
+        book = self.read('1')
+        self.assertEqual(book.title, u'Book 0')
+        self.assertIn(book, self.adapter.session)
+        self.assertEqual(len(self.statements), 1)
+
+    def test_not_found(self):
+        self.assertRaises(sqlalchemy.orm.exc.NoResultFound, self.read, 99)
+
+    def test_invalidate_on_update(self):
+        self.read(1)
+        self.adapter.do_update(None, self.request(), {'id': 1},
+                               title=u'Changed')
+        self.assertEqual(self.read(1).title, u'Changed')
+
+    def test_invalidate_failure(self):
+        self.adapter.object_cache = ObjectCache(backend=BrokenBackend())
+        self.adapter.session = self.session
+        self.adapter.do_update(None, self.request(), {'id': 1},
+                               title=u'Changed')
+        self.assertEqual(self.Session().query(Book).get(1).title,
+                         u'Changed')
+
+
+class TestsConditionalGet(DeformTestsBase):
+
+    def read(self, id, **headers):
+        request = self.request(matchdict={'id': id}, headers=headers)
+        return request, self.adapter.read(None, request)
+
+    def search(self, **headers):
+        headers['X-Requested-With'] = 'XMLHttpRequest'
+        request = self.request([('order_by', 'id')], headers=headers)
+        return request, self.adapter.search(None, request)
+
+    def test_read(self):
+        request, response = self.read('1')
+        etag = request.response.etag
+        self.assertTrue(etag)
+        request, response = self.read('1', **{'If-None-Match': etag})
+        self.assertIsInstance(response, HTTPNotModified)
+        self.assertEqual(response.etag, etag)
+        book = self.session.query(Book).get(1)
+        book.pages = 1
+        self.session.commit()
+        request, response = self.read('1', **{'If-None-Match': etag})
+        self.assertEqual(request.response.status_int, 200)
+        self.assertNotEqual(request.response.etag, etag)
+
+    def test_search(self):
+        request, response = self.search()
+        etag = request.response.etag
+        request, response = self.search(**{'If-None-Match': etag})
+        self.assertIsInstance(response, HTTPNotModified)
+        self.session.add(Book(id=11, title=u'New'))
+        self.session.commit()
+        request, response = self.search(**{'If-None-Match': etag})
+        self.assertEqual(request.response.status_int, 200)
+
+    def test_last_modified(self):
+        modified = datetime(2012, 1, 1, 12, 0, 0, 500, tzinfo=UTC)
+        request = self.request(headers={'If-Modified-Since':
+                                        'Sun, 01 Jan 2012 12:00:00 GMT'})
+        self.assertRaises(HTTPNotModified, check_not_modified, request,
+                          None, modified)
+        request = self.request(headers={'If-Modified-Since':
+                                        'Sun, 01 Jan 2012 11:59:59 GMT'})
+        check_not_modified(request, None, modified)
+        self.assertTrue(request.response.last_modified)
+
+
+FulltextBase = sqlalchemy.ext.declarative.declarative_base()
+
+
+class Article(FulltextBase):
+    __tablename__ = 'articles'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    title = sqlalchemy.Column(sqlalchemy.Unicode(128))
+    body = sqlalchemy.Column(sqlalchemy.UnicodeText)
+    author = sqlalchemy.Column(sqlalchemy.Unicode(128))
+
+
+declare_fulltext_index(Article, 'title', 'body')
+
+
+class TestsFulltext(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine('sqlite://', echo=False)
+        FulltextBase.metadata.create_all(self.engine)
+        self.session = sqlalchemy.orm.sessionmaker(bind=self.engine)()
+        self.session.add_all([
+            Article(id=1, title=u'The quick brown fox', body=u'Jumps.',
+                    author=u'Fox'),
+            Article(id=2, title=u'Lazy dogs', body=u'The fox is quick.',
+                    author=u'Dog'),
+            Article(id=3, title=u'Quick "quotes"', body=u'None here.',
+                    author=u'Foxy')])
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def search(self, column, text):
+        query = self.session.query(Article.id)\
+                            .filter(fulltext_match(column, text))\
+                            .order_by(Article.id)
+        return [row.id for row in query]
+
+    def compile(self, column, dialect):
+        criterion = fulltext_match(column, u'quick fox')
+        return str(criterion.compile(dialect=dialect))
+
+    def test_postgresql(self):
+        dialect = sqlalchemy.dialects.postgresql.dialect()
+        sql = self.compile(Article.title, dialect)
+        self.assertTrue(sql.startswith("to_tsvector('simple', articles.title)"
+                                       " @@ plainto_tsquery('simple', "), sql)
+        self.assertIn('LIKE', self.compile(Article.author, dialect))
+
+    def test_sqlite(self):
+        self.assertEqual(self.search(Article.title, u'fox QUICK'), [1])
+        self.assertEqual(self.search(Article.body, u'quick fox'), [2])
+        self.assertEqual(self.search(Article.title, u'"quotes'), [3])
+        self.assertEqual(self.search(Article.title, u'cat'), [])
+
+    def test_sqlite_sync(self):
+        article = self.session.query(Article).get(2)
+        article.title = u'Quick cats'
+        self.session.delete(self.session.query(Article).get(1))
+        self.session.commit()
+        self.assertEqual(self.search(Article.title, u'quick'), [2, 3])
+
+    def test_like_fallback(self):
+        self.assertEqual(self.search(Article.author, u'fox'), [1, 3])
+
+
+class TestsMergedCriteria(DeformTestsBase):
+
+    def search(self, **kwargs):
+        result = self.adapter.do_search(None, self.request(), order_by='id',
+                                        **kwargs)
+        return [book.id for book in result.results]
+
+    def criteria(self, *items):
+        return [{'pages': pages, 'comparator': comparator}
+                for comparator, pages in items]
+
+    def test_merge(self):
+        metadata = get_search_metadata(Book)
+        criteria = [('pages', '__eq__', 101), ('pages', '__eq__', 103),
+                    ('pages', '__gte__', 100), ('pages', '__lte__', 105),
+                    ('title', 'like', u'Book%')]
+        self.assertEqual(metadata.merge(criteria),
+                         [('pages', 'in_', [101, 103]),
+                          ('pages', 'between', (100, 105)),
+                          ('title', 'like', u'Book%')])
+        self.assertEqual(metadata.merge(criteria[2:4], intersect=False),
+                         criteria[2:4])
+
+    def test_in(self):
+        criteria = self.criteria(('__eq__', 101), ('__eq__', 103))
+        self.assertEqual(self.search(pages_criterions=criteria), [2, 4])
+        self.assertEqual(self.search(pages_criterions=criteria,
+                                     intersect=False), [2, 4])
+
+    def test_not_in(self):
+        criteria = self.criteria(('__neq__', 101), ('__neq__', 103))
+        self.assertEqual(self.search(pages_criterions=criteria),
+                         [1, 3, 5, 6, 7, 8, 9, 10])
+
+    def test_between(self):
+        criteria = self.criteria(('__gte__', 102), ('__lte__', 104))
+        self.assertEqual(self.search(pages_criterions=criteria), [3, 4, 5])
+
+    def test_single_and_sequence(self):
+        criterion = {'pages': 101, 'comparator': '__eq__'}
+        criteria = self.criteria(('__eq__', 105))
+        self.assertEqual(self.search(pages_criterion=criterion,
+                                     pages_criterions=criteria), [2, 6])
+
+
+class FacetsAdapter(DeformBase):
+    search_facets = ('author',)
+    search_aggregates = {'pages': ('min', 'max', 'sum')}
+
+
+class TestsFacets(DeformTestsBase):
+
+    adapter_class = FacetsAdapter
+
+    def test_compute_facets(self):
+        query = self.session.query(Book)
+        facets, aggregates = compute_facets(query, Book, ['author'],
+                                            {'price': ['min', 'max']})
+        self.assertEqual(facets['author'][0], (1, 4))
+        self.assertEqual(sorted(facets['author']), [(1, 4), (2, 3), (3, 3)])
+        self.assertEqual(Decimal(aggregates['price']['min']).quantize(
+            Decimal('0.01')), Decimal('9.99'))
+        self.assertEqual(Decimal(aggregates['price']['max']).quantize(
+            Decimal('0.01')), Decimal('18.99'))
+
+    def test_invalid(self):
+        query = self.session.query(Book)
+        self.assertRaises(ValueError, compute_facets, query, Book,
+                          ['isbn'])
+        self.assertRaises(ValueError, compute_facets, query, Book, [],
+                          {'title': ['sum']})
+        self.assertRaises(ValueError, compute_facets, query, Book, [],
+                          {'pages': ['median']})
+
+    def test_search(self):
+        criterion = {'pages': 105, 'comparator': '__gte__'}
+        result = self.adapter.do_search(None, self.request(), limit=2,
+                                        pages_criterion=criterion)
+        self.assertEqual(len(result.results), 2)
+        self.assertEqual(sorted(result.facets['author']),
+                         [(1, 2), (2, 1), (3, 2)])
+        self.assertEqual(result.aggregates['pages'],
+                         {'min': 105, 'max': 109, 'sum': 535})
+
+
+class TestsTiming(DeformTestsBase):
+
+    def test_tween(self):
+        instrument_engine(self.engine)
+        request = self.request(matchdict={'id': '1'})
+
+        def handler(request):
+            self.adapter.read(None, request)
+            return request.response
+
+        response = timing_tween_factory(handler, self.config.registry)(request)
+        timings = request.pyramidion_timings
+        self.assertIn('query', timings.durations)
+        self.assertIn('render', timings.durations)
+        self.assertEqual(timings.phase_queries['query'], 1)
+        header = response.headers['Server-Timing']
+        self.assertIn('query;dur=', header)
+        self.assertIn('total;dur=', header)
+
+    def test_stats(self):
+        timings = Timings()
+        timings.model, timings.action = 'Book', 'read'
+        timings.durations['query'] = 0.003
+        timings.finish()
+        stats = TimingStats(buckets=(1, 5))
+        stats.record(timings)
+        histogram = stats.dump()[('Book', 'read', 'query')]
+        self.assertEqual(histogram['buckets'], [(1, 0), (5, 1), (None, 0)])
+        self.assertEqual(histogram['count'], 1)
+
+
+class TestsQueryBudget(AdapterTestsBase):
+
+    def test_limit(self):
+        budget = attach_budget(self.session, QueryBudget(2, mode='raise'))
+        self.session.query(Book).get(1)
+        self.session.query(Author).get(1)
+        self.assertEqual(budget.count, 2)
+        self.assertRaises(QueryBudgetExceeded,
+                          self.session.query(Book).all)
+
+    def test_repeated(self):
+        budget = attach_budget(self.session, QueryBudget(repeat_limit=5))
+        # Lazy loads of authors: one statement repeated by book.
+        for book in self.session.query(Book).filter(Book.id <= 3):
+            book.author.name
+
+        self.assertEqual(budget.count, 4)
+        statement, count = budget.repeated()[0]
+        self.assertIn('FROM authors', statement)
+        self.assertEqual(count, 3)
+
+    def test_repeat_limit(self):
+        attach_budget(self.session, QueryBudget(repeat_limit=2, mode='raise'))
+        books = self.session.query(Book).order_by(Book.id).all()
+        books[0].author
+        books[1].author
+        self.assertRaises(QueryBudgetExceeded, getattr, books[2], 'author')
+
+    def test_attach_in_transaction(self):
+        self.session.query(Book).get(1)
+        budget = attach_budget(self.session, QueryBudget())
+        self.session.query(Author).get(1)
+        self.assertEqual(budget.count, 1)
+
+    def test_request_budget(self):
+        request = self.request()
+        budget = attach_request_budget(request, self.session, {}, 5)
+        self.session.query(Book).get(1)
+        request._process_finished_callbacks()
+        # A session shared by requests no longer counts in it.
+        self.assertIsNone(get_budget(self.session))
+        self.session.query(Author).get(1)
+        self.assertEqual(budget.count, 1)
+
+
+class ProjectedWindowAdapter(DeformBase):
+    search_total = 'window'
+    search_projection = 'columns'
+
+    def get_search_columns(self):
+        return OrderedDict([('id', 'id'), ('title', 'title')])
+
+
+class TestsSearchWindow(DeformTestsBase):
+
+    adapter_class = ProjectedWindowAdapter
+
+    def test_window_total(self):
+        self.adapter.search_projection = None
+        result = self.adapter.do_search(None, self.request(),
+                                        start=2, limit=3, order_by='id')
+        self.assertEqual([book.id for book in result.results], [3, 4, 5])
+        self.assertEqual(result.paginator.total, 10)
+
+    def test_window_projected_columns(self):
+        result = self.adapter.do_search(None, self.request(),
+                                        limit=3, order_by='id')
+        self.assertEqual(result.results,
+                         [(1, u'Book 0'), (2, u'Book 1'), (3, u'Book 2')])
+        self.assertEqual([tuple(row) for row in result.rows()],
+                         [(1, u'Book 0'), (2, u'Book 1'), (3, u'Book 2')])
+        self.assertEqual(result.paginator.total, 10)
+
+    def test_window_past_last_page(self):
+        result = self.adapter.do_search(None, self.request(),
+                                        start=20, limit=3, order_by='id')
+        self.assertEqual(result.results, [])
+        self.assertEqual(result.paginator.total, 10)
+
+    def test_mysql_window_functions(self):
+        dialect = sqlalchemy.dialects.mysql.dialect()
+        for version, supported in [((8, 0, 21), True),
+                                   ((5, 7, 30), False),
+                                   ((10, 3, 7, 'MariaDB'), True),
+                                   ((10, 1, 44, 'MariaDB'), False)]:
+            dialect.server_version_info = version
+            dialect.is_mariadb = 'MariaDB' in version
+            self.assertEqual(supports_window_functions(dialect), supported,
+                             version)
+
+
+class TestsSearchParams(DeformTestsBase):
+
+    def search(self, params, xhr=True):
+        headers = {'X-Requested-With': 'XMLHttpRequest'} if xhr else {}
+        request = self.request(params, headers=headers)
+        return request, self.adapter.search(None, request)
+
+    def date_criterion(self, value, comparator):
+        return [('__start__', 'published_criterion:mapping'),
+                ('__start__', 'published:mapping'),
+                ('date', value),
+                ('__end__', 'published:mapping'),
+                ('comparator', comparator),
+                ('__end__', 'published_criterion:mapping')]
+
+    def test_load_plan(self):
+        first = self.adapter.do_search(None, self.request(), limit=3)
+        second = self.adapter.do_search(None, self.request(), start=3)
+        self.assertEqual(first.load_plan.report(), 'author: joined')
+        self.assertIs(first.load_plan, second.load_plan)
+
+    def test_date_range_criterion(self):
+        params = self.date_criterion('2012-01-08', '__gte__')
+        request, response = self.search(params + [('order_by', 'id')])
+        self.assertEqual(request.response.status_int, 200)
+        self.assertEqual([book.id for book in response['result'].results],
+                         [8, 9, 10])
+        params = self.date_criterion('2012-01-03', '__lt__')
+        request, response = self.search(params + [('order_by', 'id')])
+        self.assertEqual([book.id for book in response['result'].results],
+                         [1, 2])
+
+    def test_invalid_date_criterion(self):
+        params = self.date_criterion('2012-13-01', '__gte__')
+        request, response = self.search(params)
+        self.assertEqual(request.response.status_int, 400)
+        self.assertIsNone(response['form'])
+
+    def test_string_for_mapping(self):
+        request, response = self.search([('published_criterion',
+                                          '2012-01-08')])
+        self.assertEqual(request.response.status_int, 400)
+
+    def test_invalid_params_render_form(self):
+        request, response = self.search([('limit', '0')], xhr=False)
+        self.assertEqual(request.response.status_int, 400)
+        self.assertIn('<form', response['form'])
+
+    def test_string_for_mapping_render_form(self):
+        request, response = self.search([('published_criterion',
+                                          '2012-01-08')], xhr=False)
+        self.assertEqual(request.response.status_int, 400)
+        self.assertIn('<form', response['form'])
+
+
+class TestsKeysetCursor(DeformTestsBase):
+
+    def search(self, params):
+        request = self.request(params, headers={'X-Requested-With':
+                                                'XMLHttpRequest'})
+        return request, self.adapter.search(None, request)
+
+    def test_cursor_round_trip(self):
+        self.adapter.search_pagination = 'keyset'
+        result = self.adapter.do_search(None, self.request(),
+                                        limit=4, order_by='pages')
+        self.assertEqual([book.id for book in result.results], [1, 2, 3, 4])
+        cursor = result.paginator.next_cursor
+        result = self.adapter.do_search(None, self.request(),
+                                        limit=4, cursor=cursor)
+        self.assertEqual([book.id for book in result.results], [5, 6, 7, 8])
+
+    def test_cursor_with_projection(self):
+        statements = []
+
+        def before_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        self.adapter.search_pagination = 'keyset'
+        self.adapter.get_search_columns = lambda: OrderedDict(
+            [('id', 'id'), ('title', 'title')])
+        engine = self.session.get_bind()
+        sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                                before_execute)
+        try:
+            for mode in ('columns', 'load_only'):
+                self.adapter.search_projection = mode
+                del statements[:]
+                result = self.adapter.do_search(None, self.request(),
+                                                limit=4, order_by='pages')
+                self.assertEqual([book.id for book in result.results],
+                                 [1, 2, 3, 4])
+                # Sort keys are read from the page rows, not lazy loaded.
+                self.assertEqual(len(statements), 1, mode)
+                cursor = result.paginator.next_cursor
+                result = self.adapter.do_search(None, self.request(),
+                                                limit=4, cursor=cursor)
+                self.assertEqual([book.id for book in result.results],
+                                 [5, 6, 7, 8])
+
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute',
+                                    before_execute)
+
+    def test_cursor_param(self):
+        cursor = encode_cursor('pages', 'asc', [107, 8])
+        request, response = self.search([('cursor', cursor),
+                                         ('limit', '4')])
+        self.assertEqual(request.response.status_int, 200)
+        self.assertEqual([book.id for book in response['result'].results],
+                         [9, 10])
+
+    def test_tampered_cursor(self):
+        for cursor in [encode_cursor('pages', 'asc', [107]),
+                       encode_cursor('isbn', 'asc', [1]),
+                       encode_cursor('price', 'asc', ['cheap', 1]),
+                       'not a cursor']:
+            request, response = self.search([('cursor', cursor)])
+            self.assertEqual(request.response.status_int, 400, cursor)
+            self.assertIn('cursor', response['error'])
+
+    def test_cursor_validator(self):
+        validator = CursorValidator(Book)
+        node = colander.SchemaNode(colander.String(), name='cursor')
+        validator(node, encode_cursor('pages', 'desc', [100, 1]))
+        self.assertRaises(colander.Invalid, validator, node,
+                          encode_cursor('pages', 'desc', [100]))
+
+
+class TestsQuerySpecCompiler(AdapterTestsBase):
+
+    def setUp(self):
+        AdapterTestsBase.setUp(self)
+        self.compiler = QuerySpecCompiler(Book)
+
+    def search(self, spec):
+        criterions, order_by, params = self.compiler.compile(spec)
+        query = self.session.query(Book).filter(*criterions)
+        return [book.id for book in query.order_by(*order_by).params(params)]
+
+    def test_compile(self):
+        spec = {'criterions': [{'attr': 'pages', 'comparator': '__ge__',
+                                'value': 105}],
+                'orderby': [{'attr': 'pages', 'order': 'desc'}]}
+        self.assertEqual(self.search(spec), [10, 9, 8, 7, 6])
+
+    def test_in(self):
+        spec = {'criterions': [{'attr': 'id', 'comparator': 'in_',
+                                'value': [2, 4]}]}
+        self.assertEqual(self.search(spec), [2, 4])
+
+    def test_shape_cache(self):
+        spec = {'criterions': [{'attr': 'title', 'comparator': 'like',
+                                'value': 'Book 1%'}]}
+        self.assertEqual(self.search(spec), [2])
+        compiled = self.compiler.compile(spec)
+        spec['criterions'][0]['value'] = 'Book 2'
+        self.assertEqual(self.compiler.compile(spec)[:2], compiled[:2])
+        self.assertEqual(self.search(spec), [3])
+
+    def test_null(self):
+        spec = {'criterions': [{'attr': 'pages', 'comparator': '__eq__',
+                                'value': None}]}
+        self.assertEqual(self.search(spec), [])
+
+    def test_invalid(self):
+        for criterion in [{'attr': 'isbn', 'comparator': '__eq__',
+                           'value': 1},
+                          {'attr': 'id', 'comparator': 'delete',
+                           'value': 1},
+                          {'attr': 'id', 'comparator': 'in_', 'value': 1},
+                          {'attr': 'id', 'comparator': 'in_', 'value': []},
+                          {'attr': 'id', 'comparator': 'in_',
+                           'value': None},
+                          {'attr': 'id', 'comparator': '__eq__',
+                           'value': [1, 2]},
+                          {'attr': 'id', 'comparator': '__eq__'}]:
+            self.assertRaises(InvalidQuery, self.compiler.compile,
+                              {'criterions': [criterion]})
+
+        self.assertRaises(InvalidQuery, self.compiler.compile,
+                          {'orderby': [{'attr': 'id', 'order': 'up'}]})
+        self.assertRaises(InvalidQuery, self.compiler.compile, [])
+
+
+class TestsWarmup(AdapterTestsBase):
+
+    def test_warmup_queries(self):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        book = Book(title=u'Draft')
+        self.session.add(book)
+        sqlalchemy.event.listen(self.engine, 'before_cursor_execute', count)
+        try:
+            setup_routing(self.config, '', [Book], DeformBase, warmup=True,
+                          session_factory=self.Session)
+
+        finally:
+            sqlalchemy.event.remove(self.engine, 'before_cursor_execute',
+                                    count)
+
+        report = self.config.registry.pyramidion_warmup
+        self.assertEqual(list(report['Book']),
+                         ['mappers', 'metadata', 'forms', 'load_plan',
+                          'queries'])
+        warmed = [s for s in statements if 'FROM books' in s]
+        self.assertTrue(warmed)
+        # The session of the caller is left alone.
+        self.assertIn(book, self.session.new)
+        # Statements are the ones of a search without params.
+        del statements[:]
+        adapter = DeformBase(Book, session=self.Session())
+        sqlalchemy.event.listen(self.engine, 'before_cursor_execute', count)
+        try:
+            adapter.do_search(None, self.request())
+
+        finally:
+            sqlalchemy.event.remove(self.engine, 'before_cursor_execute',
+                                    count)
+
+        self.assertEqual([s for s in statements if 'FROM books' in s],
+                         warmed)
+
+    def test_warmup_without_session(self):
+        setup_routing(self.config, '', [Book], DeformBase, warmup=True)
+        report = self.config.registry.pyramidion_warmup
+        self.assertNotIn('queries', report['Book'])
+
+
+class EmberTestsBase(AdapterTestsBase):
+
+    adapter_class = EmberDataBase
+
+    def setUp(self):
+        AdapterTestsBase.setUp(self)
+        self.adapter = self.adapter_class(Book)
+
+    def request(self, params=(), matchdict=None, **kw):
+        request = AdapterTestsBase.request(self, params, matchdict, **kw)
+        request.db_session = self.session
+        return request
+
+    def json_request(self, body, method='POST', matchdict=None):
+        request = self.request(matchdict=matchdict, method=method)
+        request.json_body = body
+        return request
+
+
+class StreamingAdapter(EmberDataBase):
+    stream_json = True
+    stream_chunk_size = 3
+
+
+class TestsEmberJSON(EmberTestsBase):
+
+    adapter_class = StreamingAdapter
+
+    def test_decimal_as_string(self):
+        serializer = self.adapter.get_serializer(self.adapter.read_schema)
+        book = self.session.query(Book).get(1)
+        self.assertEqual(serializer(book)['price'], '9.99')
+
+    def test_stream_search(self):
+        request = self.request()
+        response = self.adapter.search(None, request)
+        self.assertEqual(request.response.status_int, 200)
+        books = list(response['books'])
+        self.assertEqual([book['id'] for book in books], list(range(1, 11)))
+        self.assertIsNone(request.response.etag)
+
+    def test_stream_after_session_closed(self):
+        request = self.request()
+        response = self.adapter.search(None, request)
+        # As closed by the application before the response is written:
+        # rows are streamed from another session.
+        self.session.close()
+        begins = []
+        sqlalchemy.event.listen(self.session, 'after_begin',
+                                lambda *args: begins.append(args))
+        books = list(response['books'])
+        self.assertEqual([book['id'] for book in books], list(range(1, 11)))
+        self.assertEqual(begins, [])
+
+    def test_stream_renderer(self):
+        self.assertRaises(ConfigurationError, self.adapter.setup_routing,
+                          self.config)
+        self.config.add_renderer('json_stream', StreamingJSON())
+        self.adapter.renderer = 'json_stream'
+        self.adapter.setup_routing(self.config)
+
+    def test_stream_render_without_request(self):
+        render = StreamingJSON()(None)
+        value = {'books': iter([{'id': 1}, {'id': 2}])}
+        self.assertEqual(json.loads(render(value, {})),
+                         {'books': [{'id': 1}, {'id': 2}]})
+
+
+class TestsRenderCache(DeformTestsBase):
+
+    def read(self, id):
+        request = self.request(matchdict={'id': id})
+        return self.adapter.read(None, request)['form']
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(self.adapter.render_cache)
+        self.assertIn('Book 0', self.read(1))
+
+    def edit(self, id):
+        request = self.request(matchdict={'id': id})
+        return self.adapter.edit(None, request)['form']
+
+    def test_cache(self):
+        self.adapter.render_cache = RenderCache()
+        html = self.read(1)
+        self.assertEqual(self.read(1), html)
+        self.assertIn('Book 0', self.edit(1))
+        self.assertIn('Book 0', self.edit(1))
+        stats = self.adapter.render_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+
+    def test_invalidate_on_update(self):
+        self.adapter.render_cache = RenderCache()
+        self.read(1)
+        self.edit(1)
+        self.read(2)
+        self.adapter.do_update(None, self.request(), {'id': 1},
+                               title=u'Changed')
+        self.assertIn('Changed', self.read(1))
+        self.assertIn('Changed', self.edit(1))
+        self.assertIn('Book 1', self.read(2))
+        stats = self.adapter.render_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 5))
+
+
+class TestsEmberBulk(EmberTestsBase):
+
+    def statuses(self, response):
+        return [item['status'] for item in response['meta']['statuses']]
+
+    def test_create_many(self):
+        request = self.json_request({'books': [{'id': 11, 'title': u'New'},
+                                               {'id': 12, 'title': u'New'}]})
+        response = self.adapter.create(None, request)
+        self.assertEqual(request.response.status_int, 201)
+        self.assertEqual(self.statuses(response), [201, 201])
+        self.assertEqual(self.session.query(Book).count(), 12)
+
+    def test_create_many_multi_status(self):
+        request = self.json_request({'books': [{'id': 11, 'title': u'New'},
+                                               {'id': 12, 'pages': 1}]})
+        response = self.adapter.create(None, request)
+        self.assertEqual(request.response.status_int, 207)
+        self.assertEqual(self.statuses(response), [201, 400])
+        self.assertEqual(response['books'][1], None)
+        self.assertEqual(self.session.query(Book).count(), 11)
+
+    def test_create_many_conflict(self):
+        request = self.json_request({'books': [{'id': 11, 'title': u'New'},
+                                               {'id': 1, 'title': u'Dup'}]})
+        response = self.adapter.create(None, request)
+        self.assertEqual(request.response.status_int, 409)
+        self.assertNotIn('meta', response)
+        self.assertEqual(self.session.query(Book).count(), 10)
+
+    def test_update_many_partial(self):
+        request = self.json_request({'books': [{'id': 1, 'pages': 1},
+                                               {'id': 2, 'title': u'Two'}]},
+                                    method='PUT')
+        response = self.adapter.update_many(None, request)
+        self.assertEqual(request.response.status_int, 200)
+        self.assertEqual(self.statuses(response), [200, 200])
+        one, two = self.session.query(Book).order_by(Book.id)[:2]
+        self.assertEqual((one.title, one.pages), (u'Book 0', 1))
+        self.assertEqual((two.title, two.pages), (u'Two', 101))
+        self.assertEqual(one.price, Decimal('9.99'))
+
+    def test_update_many_multi_status(self):
+        request = self.json_request({'books': [{'id': 1, 'pages': 'many'},
+                                               {'id': 99, 'pages': 1},
+                                               {'pages': 1},
+                                               {'id': 3, 'pages': 1}]},
+                                    method='PUT')
+        response = self.adapter.update_many(None, request)
+        self.assertEqual(request.response.status_int, 207)
+        self.assertEqual(self.statuses(response), [400, 404, 400, 200])
+        self.assertIn('pages', response['meta']['statuses'][0]['errors'])
+
+    def test_update_many_invalidation_failure(self):
+        self.adapter.object_cache = ObjectCache(backend=BrokenBackend())
+        request = self.json_request({'books': [{'id': 1, 'pages': 1}]},
+                                    method='PUT')
+        self.adapter.update_many(None, request)
+        self.assertEqual(request.response.status_int, 200)
+        self.assertEqual(self.Session().query(Book).get(1).pages, 1)
+
+    def test_delete_many(self):
+        request = self.json_request({'books': [1, 2, 99]}, method='DELETE')
+        response = self.adapter.delete_many(None, request)
+        self.assertEqual(request.response.status_int, 207)
+        self.assertEqual(self.statuses(response), [200, 200, 404])
+        self.assertEqual(self.session.query(Book).count(), 8)
+
+    def test_update_many_statements(self):
+        updates = []
+
+        def before_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+            if statement.startswith('UPDATE'):
+                updates.append(executemany)
+
+        engine = self.session.get_bind()
+        sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                                before_execute)
+        try:
+            request = self.json_request({'books': [{'id': 1, 'pages': 1},
+                                                   {'id': 2, 'pages': 2},
+                                                   {'id': 3, 'pages': 3}]},
+                                        method='PUT')
+            response = self.adapter.update_many(None, request)
+
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute',
+                                    before_execute)
+
+        self.assertEqual(updates, [True])
+        self.assertEqual([book['pages'] for book in response['books']],
+                         [1, 2, 3])
+        self.assertEqual(self.Session().query(Book).get(3).pages, 3)
+
+    def test_bulk_route_names(self):
+        # Plural equal to singular: bulk routes must not replace item ones.
+        self.adapter.collection = self.adapter.element
+        self.adapter.setup_routing(self.config)
+        mapper = self.config.get_routes_mapper()
+        self.assertEqual(mapper.get_route('book_update').pattern,
+                         '/book/{id}')
+        self.assertEqual(mapper.get_route('book_update_bulk').pattern,
+                         '/book/bulk')
+        self.assertEqual(mapper.get_route('book_delete').pattern,
+                         '/book/{id}')
+        self.assertEqual(mapper.get_route('book_delete_bulk').pattern,
+                         '/book/bulk')
+
+
+class TestsStatementCache(DeformTestsBase):
+
+    def test_get(self):
+        calls = []
+        cache = StatementCache(listener=lambda key, seen: calls.append(seen))
+        self.assertEqual(cache.get(self.session, Book, (2,)).title, u'Book 1')
+        self.session.expunge_all()
+        self.assertEqual(cache.get(self.session, Book, (3,)).title, u'Book 2')
+        self.assertIsNone(cache.get(self.session, Book, (99,)))
+        self.assertEqual(calls, [False, True, True])
+        self.assertEqual(cache.stats(),
+                         {'shapes_seen': 2, 'new_shapes': 1, 'size': 1})
+
+    def test_baked_search(self):
+        for pages, ids in [(105, [6]), (107, [8])]:
+            params = {'pages_criterion': {'pages': pages,
+                                          'comparator': '__eq__'}}
+            result = self.adapter.do_search(None, self.request(), **params)
+            self.assertEqual([book.id for book in result.results], ids)
+
+        stats = self.adapter.statement_cache.stats()
+        self.assertEqual(stats['new_shapes'], stats['size'])
+        self.assertTrue(stats['shapes_seen'])
+
+
+class TestsPopulationCache(DeformTestsBase):
+
+    def setUp(self):
+        DeformTestsBase.setUp(self)
+        self.adapter.population_cache = PopulationCache()
+
+    def edit_form(self):
+        form = self.adapter.get_edit_form(None, self.request(), id=1)
+        return form['author'].widget
+
+    def test_disabled_by_default(self):
+        self.adapter = DeformBase(Book, session=self.session)
+        self.assertIsNone(self.adapter.population_cache)
+        widget = self.edit_form()
+        self.assertEqual([value for value, label in widget.values
+                          if value], ['1', '2', '3'])
+        self.session.add(Author(id=4, name=u'Author 3'))
+        self.session.commit()
+        self.assertEqual(len(self.edit_form().values),
+                         len(widget.values) + 1)
+        prototype = self.adapter.form_cache.forms[(Book, 'edit',
+                                                   'form-horizontal')]
+        self.assertFalse(getattr(prototype['author'].widget, 'values', None))
+
+    def test_populate(self):
+        cache = self.adapter.population_cache
+        widget = self.edit_form()
+        self.assertEqual([value for value, label in widget.values
+                          if value], ['1', '2', '3'])
+        self.assertEqual(self.edit_form().values, widget.values)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_widget_copies(self):
+        first = self.edit_form()
+        second = self.edit_form()
+        self.assertIsNot(first, second)
+        prototype = self.adapter.form_cache.forms[(Book, 'edit',
+                                                   'form-horizontal')]
+        self.assertIsNot(prototype['author'].widget, first)
+        self.assertFalse(getattr(prototype['author'].widget, 'values', None))
+
+    def test_generation(self):
+        cache = self.adapter.population_cache
+        count = len(self.edit_form().values)
+        generation = cache.generation
+        # Reloaded with the same values, as after the TTL expired.
+        cache.invalidate(Author)
+        self.edit_form()
+        self.assertEqual(cache.generation, generation)
+        self.session.add(Author(id=4, name=u'Author 3'))
+        self.session.commit()
+        cache.invalidate(Author)
+        self.assertEqual(len(self.edit_form().values), count + 1)
+        self.assertEqual(cache.generation, generation + 1)